@@ -0,0 +1,177 @@
+"""
+チャット履歴の保存・復元のテスト
+"""
+import json
+from collections import deque
+
+import pytest
+from thonnycontrib.thonny_codemate.ui.chat_view import (
+    LLMChatView,
+    HISTORY_KEEP,
+    HISTORY_REWRITE_THRESHOLD,
+    MAX_CHAT_HISTORY,
+)
+from thonnycontrib.thonny_codemate.ui.chat_view_html import (
+    LLMChatViewHTML,
+    HISTORY_SAVE_LIMIT,
+    MAX_MESSAGES,
+)
+
+
+@pytest.fixture
+def view():
+    """Tkを使わずに履歴処理だけを動かすビュー"""
+    view = LLMChatViewHTML.__new__(LLMChatViewHTML)
+    view.messages = deque(maxlen=MAX_MESSAGES)
+    view._message_count = 0
+    view._persistable_messages = deque(maxlen=HISTORY_SAVE_LIMIT)
+    view._unsaved_count = 0
+    view._saved_line_count = 0
+    view._rewrite_history = False
+    view._llm_ready = False
+    view._history_loaded = False
+    view._processing = False
+    view.message_queue = deque()
+    view._wakeup = lambda: None
+    # HTMLへの追加と保存の予約は行わない
+    view._append_messages_js = lambda batch, scroll=True: None
+    view._schedule_save = lambda: None
+    return view
+
+
+def _save(view, path):
+    """UIスレッド側の収集とI/Oワーカー側の書き込みを続けて行う"""
+    messages, rewrite = view._collect_history_to_save()
+    view._write_chat_history(path, messages, rewrite)
+
+
+def _read_lines(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestHistoryPersistence:
+    """履歴ファイルへの保存のテスト"""
+
+    def test_only_new_messages_are_appended(self, view, tmp_path):
+        """保存済みのメッセージは再度追記されないテスト"""
+        path = tmp_path / "chat_history.jsonl"
+        view._add_message("user", "q1")
+        view._add_message("assistant", "a1")
+        _save(view, path)
+        view._add_message("user", "q2")
+        _save(view, path)
+
+        assert [m["text"] for m in _read_lines(path)] == ["q1", "a1", "q2"]
+
+    def test_status_messages_are_not_saved(self, view, tmp_path):
+        """"["で始まるシステムメッセージは保存されないテスト"""
+        path = tmp_path / "chat_history.jsonl"
+        view._add_message("system", "[Generation stopped by user]")
+        view._add_message("user", "q1")
+        _save(view, path)
+
+        assert [m["text"] for m in _read_lines(path)] == ["q1"]
+
+    def test_restore_keeps_messages_recorded_before_load(self, view, tmp_path):
+        """読み込み完了前に記録されたメッセージが失われず、読み込んだ行が重複しないテスト"""
+        path = tmp_path / "chat_history.jsonl"
+        path.write_text(
+            '{"sender": "user", "text": "q1"}\n{"sender": "assistant", "text": "a1"}\n',
+            encoding="utf-8",
+        )
+        # 履歴の非同期読み込みより先に接続メッセージが追加される
+        view._add_message("system", "Connected to API")
+        view._apply_loaded_history(view._read_chat_history(path))
+        view._add_message("user", "q2")
+        _save(view, path)
+
+        texts = [m["text"] for m in _read_lines(path)]
+        assert texts == ["q1", "a1", "Connected to API", "Previous conversation restored", "q2"]
+        assert view._saved_line_count == len(texts)
+
+    def test_rewrite_writes_loaded_rows_first(self, view, tmp_path):
+        """書き直し時も読み込んだ行が先に並ぶテスト"""
+        path = tmp_path / "chat_history.jsonl"
+        path.write_text('{"sender": "user", "text": "q1"}\n', encoding="utf-8")
+        view._add_message("system", "Connected to API")
+        view._apply_loaded_history(view._read_chat_history(path))
+        view._rewrite_history = True
+        _save(view, path)
+
+        texts = [m["text"] for m in _read_lines(path)]
+        assert texts == ["q1", "Connected to API", "Previous conversation restored"]
+
+    def test_sending_waits_for_history(self, view, tmp_path):
+        """履歴はメッセージキュー経由で復元され、それまで送信しないテスト"""
+        path = tmp_path / "chat_history.jsonl"
+        path.write_text('{"sender": "user", "text": "q1"}\n', encoding="utf-8")
+        view._send_message()  # 復元前は何もしない（入力欄にも触れない）
+
+        view._post(("history", view._read_chat_history(path)))
+        msg_type, content = view.message_queue.popleft()
+        assert msg_type == "history"
+        view._apply_loaded_history(content)
+
+        assert view._history_loaded is True
+        assert [m.text for m in view.messages][0] == "q1"
+
+
+class TestConversationWindow:
+    """LLMに送る会話履歴の範囲のテスト"""
+
+    @pytest.mark.parametrize("turns", range(1, 30))
+    def test_never_sends_fewer_than_configured(self, view, turns):
+        """設定した件数より少ない履歴を送らないテスト"""
+        max_history = 10
+        view._processing = False
+        view._last_prefix_hash = None
+        view._options = {"max_conversation_history": max_history}
+        view._get_system_prompt = lambda: "system"
+        for i in range(turns):
+            view._record_message("user" if i % 2 == 0 else "assistant", f"m{i}")
+
+        history = view._prepare_conversation_history()[1:]
+        assert len(history) >= min(max_history, turns)
+        assert len(history) < max_history + max_history // 2
+        assert history[-1]["content"] == f"m{turns - 1}"
+
+
+class TestTextViewHistory:
+    """テキストビューの履歴保存のテスト"""
+
+    @pytest.fixture
+    def text_view(self, tmp_path):
+        view = LLMChatView.__new__(LLMChatView)
+        view.chat_history = deque(maxlen=MAX_CHAT_HISTORY)
+        view._unsaved_count = 0
+        view._rewrite_history = False
+        view._saved_line_count = 0
+        view._get_chat_history_path = lambda: tmp_path / "chat_history.jsonl"
+        return view
+
+    def _record(self, view, sender, message):
+        view.chat_history.append({"sender": sender, "message": message})
+        view._unsaved_count += 1
+
+    def test_only_new_messages_are_appended(self, text_view, tmp_path):
+        """保存済みのメッセージは再度追記されないテスト"""
+        self._record(text_view, "User", "q1")
+        text_view._save_chat_history()
+        self._record(text_view, "Assistant", "a1")
+        text_view._save_chat_history()
+
+        lines = _read_lines(tmp_path / "chat_history.jsonl")
+        assert [m["message"] for m in lines] == ["q1", "a1"]
+        assert text_view._saved_line_count == 2
+
+    def test_rewrite_keeps_latest_messages(self, text_view, tmp_path):
+        """行数が閾値に達したら最新HISTORY_KEEP件で書き直すテスト"""
+        for i in range(HISTORY_REWRITE_THRESHOLD):
+            self._record(text_view, "User", f"m{i}")
+        text_view._save_chat_history()
+
+        lines = _read_lines(tmp_path / "chat_history.jsonl")
+        assert len(lines) == HISTORY_KEEP
+        assert lines[-1]["message"] == f"m{HISTORY_REWRITE_THRESHOLD - 1}"
+        assert text_view._saved_line_count == HISTORY_KEEP
@@ -10,6 +10,7 @@ from thonnycontrib.thonny_codemate.utils.unified_error_handler import (
     with_error_handling,
     retry_decorator as retry_network_operation
 )
+from thonnycontrib.thonny_codemate.utils.error_messages import get_user_friendly_error_message
 
 
 class TestErrorContext:
@@ -140,3 +141,20 @@ class TestRetryDecorator:
         assert call_count == 3
 
 
+class TestUserFriendlyErrorMessage:
+    """ユーザー向けエラーメッセージ変換のテスト"""
+    
+    def test_keyword_mapping(self):
+        """キーワードに応じたメッセージが返されるテスト"""
+        message = get_user_friendly_error_message(Exception("Connection reset by peer"))
+        assert message == "Connection error. Please check your network and API settings."
+    
+    def test_first_match_wins(self):
+        """複数のキーワードに一致する場合は先に定義されたものが優先されるテスト"""
+        message = get_user_friendly_error_message(Exception("Invalid API key (401)"))
+        assert message == "API key error. Please check your API key in settings."
+    
+    def test_default_message_with_context(self):
+        """一致しない場合はコンテキスト付きのデフォルトメッセージになるテスト"""
+        message = get_user_friendly_error_message(ValueError("weird"), "generating response")
+        assert message.endswith(": weird")
@@ -0,0 +1,165 @@
+"""
+HTMLビューの表示方法（JavaScriptでの追加とページ再読み込み）のテスト
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import Mock
+
+import pytest
+from thonnycontrib.thonny_codemate.ui.chat_view import MessageQueueMixin
+from thonnycontrib.thonny_codemate.ui.chat_view_html import (
+    LLMChatViewHTML,
+    ChatMessage,
+    MAX_MESSAGES,
+)
+from thonnycontrib.thonny_codemate.ui.markdown_renderer import MarkdownRenderer
+
+
+@pytest.fixture
+def view():
+    """Tkを使わずに表示処理だけを動かすビュー"""
+    view = LLMChatViewHTML.__new__(LLMChatViewHTML)
+    view.messages = deque(maxlen=MAX_MESSAGES)
+    view.markdown_renderer = MarkdownRenderer()
+    view.message_queue = deque()
+    view._render_pool = ThreadPoolExecutor(max_workers=1)
+    view._html_ready = True
+    view._view_visible = True
+    view._js_enabled = True
+    view._reload_pending = False
+    view._reload_scroll = False
+    view._deferred_messages = []
+    view._deferred_scroll = False
+    view._html_ready_timeout_id = None
+    view.html_frame = Mock(spec=["load_html", "run_javascript", "yview_moveto", "html"])
+    # Tkの呼び出しは即座に実行するか無視する
+    view.after_idle = lambda func, *args: func(*args)
+    view.update_idletasks = lambda: None
+    view.tk = Mock()
+    view.tk.splitlist.return_value = ("0.0", "1.0")
+    view._wakeup = lambda: None
+    yield view
+    view._render_pool.shutdown(wait=True)
+
+
+def _drain(view):
+    """ワーカーの完了を待ってからキューを処理"""
+    view._render_pool.submit(lambda: None).result()
+    while view.message_queue:
+        msg_type, content = view.message_queue.popleft()
+        if msg_type == "js":
+            view._run_append_js(*content)
+        elif msg_type == "page":
+            view._load_page(*content)
+
+
+def _add(view, sender, text):
+    view.messages.append(ChatMessage.create(sender, text))
+    view._append_messages_js([(sender, text)])
+
+
+class TestJavaScriptFallback:
+    """JavaScriptが使えない場合のテスト"""
+
+    def test_append_uses_javascript_when_available(self, view):
+        """JavaScriptが使える場合はページを再読み込みしないテスト"""
+        _add(view, "user", "hello")
+        _drain(view)
+
+        view.html_frame.run_javascript.assert_called_once()
+        view.html_frame.load_html.assert_not_called()
+
+    def test_failed_javascript_reloads_full_page(self, view):
+        """JavaScriptが失敗したらページ全体を読み込み直すテスト"""
+        view.html_frame.run_javascript.side_effect = RuntimeError("no JavaScript backend")
+        _add(view, "user", "hello")
+        _drain(view)
+        _drain(view)
+
+        assert view._js_enabled is False
+        html = view.html_frame.load_html.call_args[0][0]
+        assert "hello" in html
+
+        # 以降のメッセージはJavaScriptを試さずに再読み込みで表示する
+        view.html_frame.run_javascript.reset_mock()
+        _add(view, "assistant", "world")
+        _drain(view)
+        view.html_frame.run_javascript.assert_not_called()
+        html = view.html_frame.load_html.call_args[0][0]
+        assert "hello" in html and "world" in html
+
+    def test_clear_without_javascript_reloads_empty_page(self, view):
+        """JavaScriptが使えない場合、クリアで空のページを読み込み直すテスト"""
+        view._js_enabled = False
+        _add(view, "user", "hello")
+        _drain(view)
+        assert "hello" in view.html_frame.load_html.call_args[0][0]
+
+        view.messages.clear()
+        view._clear_messages_js()
+        _drain(view)
+        assert "hello" not in view.html_frame.load_html.call_args[0][0]
+        view.html_frame.run_javascript.assert_not_called()
+
+    def test_failed_clear_javascript_reloads_page(self, view):
+        """クリアのJavaScriptが失敗した場合もページを読み込み直すテスト"""
+        view.html_frame.run_javascript.side_effect = RuntimeError("no JavaScript backend")
+        view.messages.append(ChatMessage.create("user", "hello"))
+        view.messages.clear()
+        view._clear_messages_js()
+        _drain(view)
+        _drain(view)
+
+        assert view._js_enabled is False
+        assert "hello" not in view.html_frame.load_html.call_args[0][0]
+
+
+class TestHtmlReadyTimeout:
+    """準備完了通知が来ない場合のテスト"""
+
+    def test_timeout_switches_to_reload(self, view):
+        """タイムアウトしたら保留中のメッセージを再読み込みで表示するテスト"""
+        view._html_ready = False
+        _add(view, "system", "Connected")
+        assert view._deferred_messages
+
+        view._on_html_ready_timeout()
+        _drain(view)
+
+        assert view._js_enabled is False
+        assert view._html_ready is True
+        assert not view._deferred_messages
+        assert "Connected" in view.html_frame.load_html.call_args[0][0]
+        view.html_frame.run_javascript.assert_not_called()
+
+
+class _RecordingQueue(MessageQueueMixin):
+    """処理したメッセージを記録するだけのキュー"""
+
+    def __init__(self):
+        self.message_queue = deque()
+        self._wakeup_pending = False
+        self.handled = []
+
+    def _wakeup(self):
+        self._wakeup_pending = True
+
+    def _handle_tokens(self, content):
+        self.handled.append(("tokens", content))
+
+    def _handle_queue_message(self, msg_type, content):
+        self.handled.append((msg_type, content))
+
+
+class TestMessageQueue:
+    """両ビュー共通のメッセージキューのテスト"""
+
+    def test_tokens_are_batched_in_order(self):
+        """連続するトークンはまとめられ、他のメッセージとの順序が保たれるテスト"""
+        q = _RecordingQueue()
+        for item in [("token", "a"), ("token", "b"), ("info", "x"), ("token", "c")]:
+            q._post(item)
+        q._drain_queue()
+
+        assert q.handled == [("tokens", "ab"), ("info", "x"), ("tokens", "c")]
+        assert not q.message_queue
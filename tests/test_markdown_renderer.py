@@ -0,0 +1,67 @@
+"""
+Markdownレンダラーのテスト
+"""
+import pytest
+from thonnycontrib.thonny_codemate.ui.markdown_renderer import (
+    MarkdownRenderer,
+    _highlight,
+)
+
+
+@pytest.fixture
+def renderer():
+    return MarkdownRenderer()
+
+
+class TestCodeBlocks:
+    """コードブロック処理のテスト"""
+
+    def test_placeholders_are_replaced(self, renderer):
+        """すべてのプレースホルダーがコードブロックに戻されるテスト"""
+        text = "before\n```python\nx = 1\n```\nmiddle ```js\nvar a;``` after"
+        html = renderer.render(text)
+        assert "CODEBLOCK" not in html
+        assert html.count('class="code-block"') == 2
+
+    def test_placeholder_like_text_is_kept(self, renderer):
+        """プレースホルダーと同じ形の本文がそのまま残るテスト"""
+        html = renderer.render("see CODEBLOCK3CODEBLOCK\n```python\nx = 1\n```")
+        assert "CODEBLOCK3CODEBLOCK" in html
+        assert html.count('class="code-block"') == 1
+
+    def test_code_source_is_escaped(self, renderer):
+        """コピー用のソースがHTMLエスケープされるテスト"""
+        html = renderer.render("```python\nprint('<a & b>')\n```")
+        assert "&lt;a &amp; b&gt;" in html
+
+    def test_highlight_is_cached(self, renderer):
+        """同じコードは再ハイライトされないテスト"""
+        _highlight.cache_clear()
+        renderer.render("```python\ny = 2\n```")
+        renderer.render("another message\n```python\ny = 2\n```")
+        info = _highlight.cache_info()
+        assert info.misses == 1
+        assert info.hits == 1
+
+    def test_block_id_is_content_addressed(self):
+        """コードブロックIDが内容だけで決まるテスト"""
+        first = MarkdownRenderer()._render_code_block("python", "z = 3")
+        second = MarkdownRenderer()._render_code_block("python", "z = 3")
+        other = MarkdownRenderer()._render_code_block("python", "z = 4")
+        assert first == second
+        assert first != other
+
+    def test_unknown_language_falls_back(self, renderer):
+        """未知の言語はエスケープしたプレーンテキストになるテスト"""
+        html = renderer.render("```nosuchlanguage\n<tag>\n```")
+        assert "<pre><code>&lt;tag&gt;</code></pre>" in html
+
+
+class TestSystemMessages:
+    """システムメッセージのテスト"""
+
+    def test_system_message_is_plain_text(self, renderer):
+        """システムメッセージはMarkdown変換されないテスト"""
+        html = renderer.render("**not bold** <b>", sender="system")
+        assert "<strong>" not in html
+        assert "&lt;b&gt;" in html
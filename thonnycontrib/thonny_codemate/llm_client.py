@@ -21,6 +21,42 @@ except ImportError:
     logger.addHandler(logging.NullHandler())
 
 
+# カスタムプロンプトの{skill_level}に埋め込むスキルレベルの説明
+_SKILL_LEVEL_DESCRIPTIONS = {
+    "beginner": "beginner (new to programming, needs detailed explanations, simple examples, and encouragement)",
+    "intermediate": "intermediate (familiar with basics, can understand technical terms, needs guidance on best practices)",
+    "advanced": "advanced (experienced developer, prefers concise technical explanations, interested in optimization and design patterns)"
+}
+
+# デフォルトプロンプトに追加するスキルレベル別の指示
+_SKILL_GUIDELINES = {
+    "beginner": """\n\nIMPORTANT: The user is a BEGINNER programmer. Follow these guidelines:
+- Use simple, everyday language and avoid technical jargon
+- Explain concepts step-by-step with clear examples
+- Provide encouragement and positive reinforcement
+- Anticipate common mistakes and explain how to avoid them
+- Use analogies to relate programming concepts to real-world scenarios
+- Keep code examples short and well-commented
+- Explain what each line of code does""",
+    "intermediate": """\n\nIMPORTANT: The user has INTERMEDIATE programming knowledge. Follow these guidelines:
+- Balance technical accuracy with clarity
+- Introduce best practices and coding standards
+- Explain the 'why' behind recommendations
+- Provide multiple solution approaches when relevant
+- Include error handling and edge cases
+- Reference documentation and useful resources
+- Encourage exploration of advanced features""",
+    "advanced": """\n\nIMPORTANT: The user is an ADVANCED programmer. Follow these guidelines:
+- Be concise and technically precise
+- Focus on optimization, performance, and design patterns
+- Discuss trade-offs and architectural decisions
+- Assume familiarity with programming concepts
+- Include advanced techniques and idioms
+- Reference relevant specifications and standards
+- Skip basic explanations unless specifically asked"""
+}
+
+
 def detect_gpu_availability() -> int:
     """
     GPUの利用可能性を検出し、推奨されるGPUレイヤー数を返す
@@ -275,15 +311,8 @@ Remember: Prioritize clarity and brevity. Get straight to the solution."""
             # カスタムプロンプトの場合は、変数を置換
             enhanced_prompt = base_prompt
             
-            # スキルレベルの詳細な説明を作成
-            skill_level_descriptions = {
-                "beginner": "beginner (new to programming, needs detailed explanations, simple examples, and encouragement)",
-                "intermediate": "intermediate (familiar with basics, can understand technical terms, needs guidance on best practices)",
-                "advanced": "advanced (experienced developer, prefers concise technical explanations, interested in optimization and design patterns)"
-            }
-            
             # 変数を置換
-            enhanced_prompt = enhanced_prompt.replace("{skill_level}", skill_level_descriptions.get(skill_level, skill_level))
+            enhanced_prompt = enhanced_prompt.replace("{skill_level}", _SKILL_LEVEL_DESCRIPTIONS.get(skill_level, skill_level))
             enhanced_prompt = enhanced_prompt.replace("{language}", output_language if output_language != "auto" else "the user's language")
             
             # プログラミング言語を追加
@@ -301,36 +330,8 @@ Remember: Prioritize clarity and brevity. Get straight to the solution."""
         # プログラミング言語の指示を追加
         enhanced_prompt = base_prompt + f"\n\nCurrent programming language: {prog_language}"
         
-        # スキルレベルの詳細な説明を追加
-        skill_instructions = {
-            "beginner": """\n\nIMPORTANT: The user is a BEGINNER programmer. Follow these guidelines:
-- Use simple, everyday language and avoid technical jargon
-- Explain concepts step-by-step with clear examples
-- Provide encouragement and positive reinforcement
-- Anticipate common mistakes and explain how to avoid them
-- Use analogies to relate programming concepts to real-world scenarios
-- Keep code examples short and well-commented
-- Explain what each line of code does""",
-            "intermediate": """\n\nIMPORTANT: The user has INTERMEDIATE programming knowledge. Follow these guidelines:
-- Balance technical accuracy with clarity
-- Introduce best practices and coding standards
-- Explain the 'why' behind recommendations
-- Provide multiple solution approaches when relevant
-- Include error handling and edge cases
-- Reference documentation and useful resources
-- Encourage exploration of advanced features""",
-            "advanced": """\n\nIMPORTANT: The user is an ADVANCED programmer. Follow these guidelines:
-- Be concise and technically precise
-- Focus on optimization, performance, and design patterns
-- Discuss trade-offs and architectural decisions
-- Assume familiarity with programming concepts
-- Include advanced techniques and idioms
-- Reference relevant specifications and standards
-- Skip basic explanations unless specifically asked"""
-        }
-        
         # スキルレベルの指示を追加
-        enhanced_prompt += skill_instructions.get(skill_level, "")
+        enhanced_prompt += _SKILL_GUIDELINES.get(skill_level, "")
         
         # 出力言語指示を追加
         language_instruction = self._get_language_instruction()
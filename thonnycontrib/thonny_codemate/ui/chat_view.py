@@ -5,11 +5,15 @@ GitHub Copilot風の右側パネルUIを提供
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox
 import threading
-import queue
 import logging
 import json
+import os
+import time
+from collections import deque
+from dataclasses import dataclass
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Optional, Tuple, Deque
 
 from thonny import get_workbench
 
@@ -23,7 +27,185 @@ except ImportError:
     logger.addHandler(logging.NullHandler())
 
 
-class LLMChatView(ttk.Frame):
+# ファイル拡張子と言語名の対応
+_LANG_MAP = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.cpp': 'cpp', '.c': 'c'}
+
+# キューの処理はワーカーからの仮想イベントで起動し、ポーリングは取りこぼし対策のみ（ms）
+QUEUE_SAFETY_POLL_MS = 500
+_TOKEN = "token"  # ストリーミングトークンのキュー種別
+
+# シェル出力からエラーを検出するための文字列と、後ろから遡る最大行数
+ERROR_TOKENS = ("Error", "Exception", "Traceback")
+MAX_ERROR_SCAN_LINES = 1000
+
+# メモリ上に保持する最大履歴数（古いものから自動的に破棄）
+MAX_CHAT_HISTORY = 1000
+
+# 履歴ファイル: この行数に達したら最新HISTORY_KEEP件だけを残して書き直す
+HISTORY_REWRITE_THRESHOLD = 120
+HISTORY_KEEP = 100
+
+# 履歴に残す送信者と、ファイルに保存する送信者
+_NON_SYSTEM = frozenset({"User", "Assistant", "You"})
+_PERSISTED = frozenset({"User", "Assistant"})
+
+
+@dataclass(slots=True)
+class ContextSnapshot:
+    """送信時点のエディタコンテキスト（UIスレッドで一度だけ取得）"""
+    file_name: str
+    lang: str
+    selection_lines: Optional[Tuple[int, int]] = None
+    selected_text: Optional[str] = None
+    full_text: Optional[str] = None
+    
+    def describe(self) -> str:
+        """表示用の説明（例: "main.py (lines 3-5)"）"""
+        if self.selection_lines:
+            start_line, end_line = self.selection_lines
+            return f"{self.file_name} (lines {start_line}-{end_line})"
+        return f"{self.file_name} (entire file)"
+    
+    def format(self) -> Optional[str]:
+        """プロンプト用のコンテキスト文字列に整形"""
+        if self.selected_text:
+            # 選択範囲がある場合はそれをコンテキストとして使用
+            start_line, end_line = self.selection_lines
+            return f"""File: {self.file_name}
+Selected lines: {start_line}-{end_line}
+
+```{self.lang}
+{self.selected_text}
+```"""
+        if self.full_text:
+            # 選択範囲がない場合は、ファイル全体を使用
+            return f"""File: {self.file_name}
+Full file content:
+
+```{self.lang}
+{self.full_text}
+```"""
+        return None
+
+
+def capture_context(editor, untitled_name: str = "Untitled",
+                    include_unsaved: bool = True) -> Optional[ContextSnapshot]:
+    """エディタの選択範囲またはファイル全体を取得（UIスレッドから呼ぶこと）
+    
+    Args:
+        editor: Thonnyのエディタ
+        untitled_name: 未保存ファイルの表示名
+        include_unsaved: 選択範囲がない未保存ファイルも対象にするか
+    """
+    current_file = editor.get_filename()
+    text_widget = editor.get_text_widget()
+    
+    if current_file:
+        file_name = Path(current_file).name
+        lang = _LANG_MAP.get(os.path.splitext(current_file)[1].lower(), 'python')
+    else:
+        file_name = untitled_name
+        lang = 'python'
+    
+    if text_widget.tag_ranges("sel"):
+        # 選択範囲がある場合
+        start_line = int(text_widget.index("sel.first").split(".")[0])
+        end_line = int(text_widget.index("sel.last").split(".")[0])
+        return ContextSnapshot(
+            file_name=file_name,
+            lang=lang,
+            selection_lines=(start_line, end_line),
+            selected_text=text_widget.get("sel.first", "sel.last")
+        )
+    
+    if current_file or include_unsaved:
+        # 選択範囲がない場合は、ファイル全体を取得
+        return ContextSnapshot(
+            file_name=file_name,
+            lang=lang,
+            full_text=text_widget.get("1.0", tk.END).strip()
+        )
+    
+    return None
+
+
+class MessageQueueMixin:
+    """
+    ワーカースレッドからUIスレッドへのメッセージキュー（両チャットビュー共通）
+    連続するトークンは_handle_tokensにまとめて渡し、それ以外は_handle_queue_messageに渡す
+    """
+    
+    # 1回の処理に使う時間予算（秒、Noneなら溜まっている分を全て処理）
+    queue_time_budget: Optional[float] = None
+    
+    def _init_message_queue(self, first_poll_ms: int = QUEUE_SAFETY_POLL_MS):
+        """キューを作成し、処理を起動する仮想イベントと取りこぼし対策のポーリングを設定"""
+        # append/popleftはスレッドセーフ。完了やエラーの通知を失わないよう長さの上限は設けない
+        self.message_queue: Deque[tuple] = deque()
+        self._wakeup_pending = False  # 処理待ちの仮想イベントを発行済みか
+        self.bind("<<LLMQueue>>", lambda e: self._drain_queue())
+        self._queue_check_id = self.after(first_poll_ms, self._process_queue)
+    
+    def _post(self, item: tuple):
+        """キューにメッセージを追加してUIスレッドを起こす（ワーカースレッドから呼ぶ）"""
+        self.message_queue.append(item)
+        self._wakeup()
+    
+    def _wakeup(self):
+        """キューを処理する仮想イベントを発行（発行済みなら何もしない）"""
+        if self._wakeup_pending:
+            return
+        self._wakeup_pending = True
+        try:
+            self.event_generate("<<LLMQueue>>", when="tail")
+        except (tk.TclError, RuntimeError):
+            # 発行できない場合は安全のためのポーリングで処理される
+            self._wakeup_pending = False
+    
+    def _process_queue(self):
+        """取りこぼし対策の低頻度ポーリング"""
+        self._drain_queue()
+        self._queue_check_id = self.after(QUEUE_SAFETY_POLL_MS, self._process_queue)
+    
+    def _drain_queue(self):
+        """メッセージキューを処理（連続するトークンはまとめて1回で処理）"""
+        # 処理開始後に追加されたメッセージのために再度イベントを発行させる
+        self._wakeup_pending = False
+        budget = self.queue_time_budget
+        deadline = None if budget is None else time.perf_counter() + budget
+        tokens = []
+        message_queue = self.message_queue
+        while message_queue and (deadline is None or time.perf_counter() < deadline):
+            msg_type, content = message_queue.popleft()
+            
+            if msg_type == _TOKEN:
+                tokens.append(content)
+                continue
+            
+            # 順序を保つため、他のメッセージより先に溜まったトークンを処理
+            if tokens:
+                self._handle_tokens("".join(tokens))
+                tokens.clear()
+            
+            self._handle_queue_message(msg_type, content)
+        
+        if tokens:
+            self._handle_tokens("".join(tokens))
+        
+        # 時間予算を超えて残った分は、他のイベントを処理した後に続きを処理
+        if message_queue:
+            self._wakeup()
+    
+    def _handle_tokens(self, content: str):
+        """まとめたトークンを表示（サブクラスで実装）"""
+        raise NotImplementedError
+    
+    def _handle_queue_message(self, msg_type: str, content):
+        """トークン以外のメッセージを処理（サブクラスで実装）"""
+        raise NotImplementedError
+
+
+class LLMChatView(MessageQueueMixin, ttk.Frame):
     """
     LLMとのチャットインターフェースを提供するビュー
     Thonnyの右側に表示される
@@ -36,21 +218,23 @@ class LLMChatView(ttk.Frame):
         self._init_ui()
         self._init_llm()
         
-        # メッセージキュー（スレッド間通信用）
-        self.message_queue = queue.Queue()
         self._processing = False
         self._first_token = True  # ストリーミング用のフラグ
         self._stop_generation = False  # 生成を停止するフラグ
-        self._current_assistant_message = ""  # 現在のアシスタントメッセージを追跡
+        self._current_assistant_parts = []  # 現在のアシスタントメッセージの断片
         
-        # 定期的にキューをチェック
-        self._queue_check_id = self.after(100, self._process_queue)
+        # スレッド間通信用のメッセージキュー（最初のチェックは早めに行う）
+        self._init_message_queue(first_poll_ms=100)
         
         # ウィンドウ閉じるイベントをバインド
         self.bind("<Destroy>", self._on_destroy)
         
         # チャット履歴を格納
-        self.chat_history = []
+        self.chat_history = deque(maxlen=MAX_CHAT_HISTORY)
+        self._history_path = None  # チャット履歴ファイルのパス（初回取得時に決定）
+        self._unsaved_count = 0  # chat_historyの末尾のうちファイルに未書き込みの件数
+        self._rewrite_history = False  # 次回保存時にファイルを書き直すか
+        self._saved_line_count = 0  # 履歴ファイルの行数
         
         # 会話履歴を読み込む
         self._load_chat_history()
@@ -89,7 +273,15 @@ class LLMChatView(ttk.Frame):
         status_frame = ttk.Frame(header_frame)
         status_frame.pack(side=tk.RIGHT, padx=5)
         
-        self.status_label = ttk.Label(status_frame, text="Not loaded", foreground="gray")
+        # ステータス表示用のスタイルを事前に定義（状態変化ごとに色を再設定しない）
+        style = ttk.Style(self)
+        style.configure("StatusIdle.TLabel", foreground="gray")
+        style.configure("StatusReady.TLabel", foreground="green")
+        style.configure("StatusLoading.TLabel", foreground="orange")
+        style.configure("StatusExternal.TLabel", foreground="blue")
+        style.configure("StatusError.TLabel", foreground="red")
+        
+        self.status_label = ttk.Label(status_frame, text="Not loaded", style="StatusIdle.TLabel")
         self.status_label.pack(side=tk.RIGHT)
         
         # チャット表示エリア
@@ -207,7 +399,7 @@ class LLMChatView(ttk.Frame):
                         model_path = available_model
                     else:
                         # モデルがない場合はダウンロードを促す
-                        self.status_label.config(text="No model loaded", foreground="red")
+                        self.status_label.configure(text="No model loaded", style="StatusError.TLabel")
                         self._append_message(
                             "System",
                             "No model found. Please download a model from Settings → Download Models.",
@@ -225,15 +417,15 @@ class LLMChatView(ttk.Frame):
                         return
                 
                 # 非同期でモデルをロード
-                # モデル名を表示しながらロード
-                model_name = Path(model_path).name if model_path else "model"
-                self.status_label.config(text=f"Loading {model_name}...", foreground="orange")
+                # モデル名を表示しながらロード（表示名はロード完了時にも再利用）
+                self._model_display_name = Path(model_path).name or "model"
+                self.status_label.configure(text=f"Loading {self._model_display_name}...", style="StatusLoading.TLabel")
                 self.llm_client.load_model_async(callback=self._on_model_loaded)
             else:
                 # 外部プロバイダーの場合、モデル名も含める
                 external_model = workbench.get_option("llm.external_model", "")
                 display_text = f"{external_model} ({provider})" if external_model else f"Using {provider}"
-                self.status_label.config(text=display_text, foreground="blue")
+                self.status_label.configure(text=display_text, style="StatusExternal.TLabel")
                 # config取得で外部プロバイダーが設定される
                 self.llm_client.get_config()
                 self.send_button.config(state=tk.NORMAL)
@@ -245,28 +437,25 @@ class LLMChatView(ttk.Frame):
             
         except Exception as e:
             logger.error(f"Failed to initialize LLM client: {e}")
-            self.status_label.config(text="Error loading model", foreground="red")
+            self.status_label.configure(text="Error loading model", style="StatusError.TLabel")
             self._append_message("System", f"Failed to initialize LLM: {str(e)}", "error")
     
     def _on_model_loaded(self, success: bool, error: Optional[Exception]):
         """モデル読み込み完了時のコールバック"""
         def update_ui():
             if success:
-                # モデル名を取得
-                model_path = get_workbench().get_option("llm.model_path", "")
-                model_name = Path(model_path).name if model_path else "Unknown"
-                self.status_label.config(text=f"{model_name} | Ready", foreground="green")
+                self.status_label.configure(text=f"{self._model_display_name} | Ready", style="StatusReady.TLabel")
                 self.send_button.config(state=tk.NORMAL)
                 self._append_message("System", "LLM model loaded successfully!", "assistant")
             else:
-                self.status_label.config(text="Load failed", foreground="red")
+                self.status_label.configure(text="Load failed", style="StatusError.TLabel")
                 self._append_message("System", f"Failed to load model: {error}", "error")
         
         # UIスレッドで更新
         self.after(0, update_ui)
     
-    def _append_message(self, sender: str, message: str, tag: str = None):
-        """チャット表示にメッセージを追加"""
+    def _append_message(self, sender: str, message: str, tag: str = None, record: bool = True):
+        """チャット表示にメッセージを追加（recordがFalseなら履歴には追加しない）"""
         self.chat_display.config(state=tk.NORMAL)
         
         # 送信者を表示
@@ -296,10 +485,11 @@ class LLMChatView(ttk.Frame):
         self.chat_display.config(state=tk.DISABLED)
         
         # 履歴に追加（システムメッセージ以外）
-        if sender not in ["System"] and not message.startswith("["):
+        if record and sender in _NON_SYSTEM and not message.startswith("["):
             self.chat_history.append({"sender": sender, "message": message})
+            self._unsaved_count += 1
             # ユーザーとアシスタントのメッセージのみ保存
-            if sender in ["User", "Assistant"]:
+            if sender in _PERSISTED:
                 self._save_chat_history()
     
     def _handle_send_button(self):
@@ -329,25 +519,9 @@ class LLMChatView(ttk.Frame):
         # UIをクリア
         self.input_text.delete("1.0", tk.END)
         
-        # コンテキスト情報を取得
-        context_info = None
-        if self.context_var.get() and self.context_manager:
-            workbench = get_workbench()
-            editor = workbench.get_editor_notebook().get_current_editor()
-            if editor:
-                current_file = editor.get_filename()
-                text_widget = editor.get_text_widget()
-                
-                if text_widget.tag_ranges("sel"):
-                    # 選択範囲がある場合
-                    start_line = int(text_widget.index("sel.first").split(".")[0])
-                    end_line = int(text_widget.index("sel.last").split(".")[0])
-                    file_name = Path(current_file).name if current_file else "Unknown"
-                    context_info = f"[Context: {file_name} (lines {start_line}-{end_line})]"
-                elif current_file:
-                    # ファイル全体の場合
-                    file_name = Path(current_file).name
-                    context_info = f"[Context: {file_name} (entire file)]"
+        # コンテキストを取得（Tkへのアクセスはここで一度だけ行う）
+        snapshot = self._capture_context()
+        context_info = f"[Context: {snapshot.describe()}]" if snapshot else None
         
         # ユーザーメッセージを追加（コンテキスト情報付き）
         if context_info:
@@ -363,20 +537,38 @@ class LLMChatView(ttk.Frame):
         self._stop_generation = False  # 停止フラグをリセット
         self.send_button.config(text="Stop", state=tk.NORMAL)  # ボタンを停止モードに変更
         
+        # コンテキスト文字列もUIスレッドで組み立てておく（ワーカーからTkに触れない）
+        context_str = snapshot.format() if snapshot else None
+        
         # バックグラウンドで処理
         thread = threading.Thread(
             target=self._generate_response,
-            args=(message,),  # 元のメッセージを渡す（コンテキスト情報なし）
+            args=(message, context_str),  # 元のメッセージを渡す（コンテキスト情報なし）
             daemon=True
         )
         thread.start()
     
+    def _capture_context(self) -> Optional[ContextSnapshot]:
+        """エディタのコンテキストを取得（UIスレッドから呼ぶこと）"""
+        if not (self.context_var.get() and self.context_manager):
+            return None
+        
+        editor = get_workbench().get_editor_notebook().get_current_editor()
+        if not editor:
+            return None
+        
+        # 未保存ファイルは選択範囲がある場合のみ対象にする
+        return capture_context(editor, untitled_name="Unknown", include_unsaved=False)
+    
     def _prepare_conversation_history(self, max_history: int = 10) -> list:
         """会話履歴をOpenAI API形式で準備"""
         history = []
         
-        # 最新のmax_history個のメッセージを取得
-        for msg in self.chat_history[-max_history:]:
+        # 最新のmax_history個のメッセージだけをコピーする（deque全体はコピーしない）
+        # ワーカースレッドで実行されるため、UIスレッドの追加と競合しないよう遅延評価はしない
+        history_len = len(self.chat_history)
+        recent = list(islice(self.chat_history, max(0, history_len - max_history), history_len))
+        for msg in recent:
             sender = msg.get("sender", "")
             text = msg.get("message", "")
             
@@ -392,170 +584,108 @@ class LLMChatView(ttk.Frame):
         
         return history
     
-    def _generate_response(self, message: str):
-        """バックグラウンドで応答を生成"""
+    def _generate_response(self, message: str, context_str: Optional[str]):
+        """
+        バックグラウンドで応答を生成
+        
+        ワーカースレッドで実行されるため、Tkウィジェットには一切アクセスしない
+        """
         try:
             # 会話履歴を準備
             conversation_history = self._prepare_conversation_history()
             
-            # コンテキストを含める場合
-            if self.context_var.get() and self.context_manager:
-                # 現在のエディタのファイルパスを取得
-                workbench = get_workbench()
-                editor = workbench.get_editor_notebook().get_current_editor()
-                current_file = None
-                selected_text = None
-                selection_info = None
-                
-                if editor:
-                    current_file = editor.get_filename()
-                    text_widget = editor.get_text_widget()
-                    
-                    # 選択範囲があるかチェック
-                    if text_widget.tag_ranges("sel"):
-                        selected_text = text_widget.get("sel.first", "sel.last")
-                        # 選択範囲の行番号を取得
-                        start_line = int(text_widget.index("sel.first").split(".")[0])
-                        end_line = int(text_widget.index("sel.last").split(".")[0])
-                        selection_info = f"Selected lines: {start_line}-{end_line}"
-                
-                if selected_text:
-                    # 選択範囲がある場合はそれをコンテキストとして使用
-                    # ファイル拡張子から言語を判定
-                    file_ext = Path(current_file).suffix.lower() if current_file else '.py'
-                    lang_map = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.cpp': 'cpp', '.c': 'c'}
-                    lang = lang_map.get(file_ext, 'python')
-                    
-                    context_str = f"""File: {Path(current_file).name if current_file else 'Unknown'}
-{selection_info}
-
-```{lang}
-{selected_text}
-```"""
-                    # コンテキスト使用メッセージは不要
-                elif editor and current_file:
-                    # 選択範囲がない場合は、ファイル全体を取得
-                    full_text = text_widget.get("1.0", tk.END).strip()
-                    if full_text:
-                        # ファイル拡張子から言語を判定
-                        file_ext = Path(current_file).suffix.lower()
-                        lang_map = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.cpp': 'cpp', '.c': 'c'}
-                        lang = lang_map.get(file_ext, 'python')
-                        
-                        context_str = f"""File: {Path(current_file).name}
-Full file content:
-
-```{lang}
-{full_text}
-```"""
-                        # コンテキスト使用メッセージは不要
-                    else:
-                        context_str = None
-                else:
-                    context_str = None
-                
-                if context_str:
-                    # コンテキスト付きで生成
-                    full_prompt = f"""Here is the context from the current project:
+            if context_str:
+                # コンテキスト付きで生成
+                prompt = f"""Here is the context from the current project:
 
 {context_str}
 
 Based on this context, {message}"""
-                    
-                    for token in self.llm_client.generate_stream(full_prompt, messages=conversation_history):
-                        if self._stop_generation:
-                            self.message_queue.put(("info", "\n[Generation stopped by user]"))
-                            break
-                        self.message_queue.put(("token", token))
-                else:
-                    # 通常の生成
-                    for token in self.llm_client.generate_stream(message, messages=conversation_history):
-                        if self._stop_generation:
-                            self.message_queue.put(("info", "\n[Generation stopped by user]"))
-                            break
-                        self.message_queue.put(("token", token))
             else:
                 # 通常の生成
-                for token in self.llm_client.generate_stream(message, messages=conversation_history):
-                    if self._stop_generation:
-                        self.message_queue.put(("info", "\n[Generation stopped by user]"))
-                        break
-                    self.message_queue.put(("token", token))
+                prompt = message
+            
+            self._pump_stream(self.llm_client, prompt, conversation_history)
             
             # 完了
-            self.message_queue.put(("complete", None))
+            self._post(("complete", None))
             
         except Exception as e:
             logger.error(f"Error generating response: {e}")
-            self.message_queue.put(("error", str(e)))
+            self._post(("error", str(e)))
     
-    def _process_queue(self):
-        """メッセージキューを処理"""
-        try:
-            # キューから全てのメッセージを処理
-            while True:
-                msg_type, content = self.message_queue.get_nowait()
-                
-                if msg_type == "token":
-                    if self._first_token:
-                        # 最初のトークンの時だけAssistantラベルを追加
-                        self.chat_display.config(state=tk.NORMAL)
-                        self.chat_display.insert(tk.END, "\nAssistant: ", "role")
-                        self.chat_display.config(state=tk.DISABLED)
-                        self._first_token = False
-                        self._current_assistant_message = ""  # アシスタントのメッセージを追跡開始
-                    
-                    # トークンを追加（ラベルなしで）
-                    self.chat_display.config(state=tk.NORMAL)
-                    self.chat_display.insert(tk.END, content, "assistant")
-                    self.chat_display.see(tk.END)
-                    self.chat_display.config(state=tk.DISABLED)
-                    
-                    # アシスタントのメッセージを追跡
-                    if hasattr(self, '_current_assistant_message'):
-                        self._current_assistant_message += content
-                
-                elif msg_type == "complete":
-                    # アシスタントのメッセージを履歴に保存
-                    if hasattr(self, '_current_assistant_message') and self._current_assistant_message:
-                        # 履歴に追加（_append_messageを使わずに直接追加）
-                        self.chat_history.append({"sender": "Assistant", "message": self._current_assistant_message})
-                        self._save_chat_history()
-                        self._current_assistant_message = ""
-                    
-                    self._processing = False
-                    self._stop_generation = False  # 停止フラグをリセット
-                    self.send_button.config(text="Send", state=tk.NORMAL)  # ボタンを送信モードに戻す
-                    self._first_token = True  # 次のメッセージ用にリセット
-                
-                elif msg_type == "error":
-                    # エラー前に部分的なアシスタントメッセージがあれば保存
-                    if hasattr(self, '_current_assistant_message') and self._current_assistant_message:
-                        self.chat_history.append({"sender": "Assistant", "message": self._current_assistant_message})
-                        self._save_chat_history()
-                        self._current_assistant_message = ""
-                    
-                    self._append_message("System", f"Error: {content}", "error")
-                    self._processing = False
-                    self._stop_generation = False  # 停止フラグをリセット
-                    self.send_button.config(text="Send", state=tk.NORMAL)  # ボタンを送信モードに戻す
-                    self._first_token = True  # 次のメッセージ用にリセット
-                
-                elif msg_type == "info":
-                    # 停止メッセージの前に部分的なアシスタントメッセージがあれば保存
-                    if "Generation stopped" in content and hasattr(self, '_current_assistant_message') and self._current_assistant_message:
-                        self.chat_history.append({"sender": "Assistant", "message": self._current_assistant_message})
-                        self._save_chat_history()
-                        self._current_assistant_message = ""
-                    
-                    self._append_message("System", content, "assistant")
-                    self._first_token = True  # 次のメッセージ用にリセット
-        
-        except queue.Empty:
-            pass
+    def _pump_stream(self, llm_client, prompt: str, conversation_history: list):
+        """ストリーミング生成のトークンをキューへ流す（トークンごとに呼ばれるホットループ）"""
+        post = self._post  # ループ内での属性参照を避ける
+        for token in llm_client.generate_stream(prompt, messages=conversation_history):
+            if self._stop_generation:
+                post(("info", "\n[Generation stopped by user]"))
+                break
+            post((_TOKEN, token))
+    
+    def _handle_queue_message(self, msg_type: str, content):
+        """トークン以外のメッセージを処理"""
+        if msg_type == "complete":
+            # アシスタントのメッセージを履歴に保存
+            self._save_assistant_message()
+            
+            self._processing = False
+            self._stop_generation = False  # 停止フラグをリセット
+            self.send_button.config(text="Send", state=tk.NORMAL)  # ボタンを送信モードに戻す
+            self._first_token = True  # 次のメッセージ用にリセット
+        
+        elif msg_type == "error":
+            # エラー前に部分的なアシスタントメッセージがあれば保存
+            self._save_assistant_message()
+            
+            self._append_message("System", f"Error: {content}", "error")
+            self._processing = False
+            self._stop_generation = False  # 停止フラグをリセット
+            self.send_button.config(text="Send", state=tk.NORMAL)  # ボタンを送信モードに戻す
+            self._first_token = True  # 次のメッセージ用にリセット
+        
+        elif msg_type == "info":
+            # 停止メッセージの前に部分的なアシスタントメッセージがあれば保存
+            if "Generation stopped" in content:
+                self._save_assistant_message()
+            
+            self._append_message("System", content, "assistant")
+            self._first_token = True  # 次のメッセージ用にリセット
+    
+    def _handle_tokens(self, content: str):
+        """まとめたトークンを挿入し、ユーザーが最下部を見ていた場合のみスクロール"""
+        # 自動スクロールはトークンごとではなくまとめた挿入につき1回だけ
+        follow_tail = self.chat_display.yview()[1] > 0.98
+        self._insert_tokens(content)
+        if follow_tail:
+            self.chat_display.see(tk.END)
+    
+    def _insert_tokens(self, content: str):
+        """まとめたトークンをチャット表示に挿入"""
+        self.chat_display.config(state=tk.NORMAL)
+        if self._first_token:
+            # 最初のトークンの時だけAssistantラベルを追加
+            self.chat_display.insert(tk.END, "\nAssistant: ", "role")
+            self._first_token = False
+            self._current_assistant_parts = []  # アシスタントのメッセージを追跡開始
+        
+        # トークンを追加（ラベルなしで）
+        self.chat_display.insert(tk.END, content, "assistant")
+        self.chat_display.config(state=tk.DISABLED)
         
-        # 次のチェックをスケジュール
-        self.after(50, self._process_queue)
+        # アシスタントのメッセージを追跡（結合は保存時に一度だけ）
+        self._current_assistant_parts.append(content)
+    
+    def _save_assistant_message(self):
+        """追跡中のアシスタントメッセージを履歴に追加して保存"""
+        if not self._current_assistant_parts:
+            return
+        # 履歴に追加（_append_messageを使わずに直接追加）
+        message = "".join(self._current_assistant_parts)
+        self._current_assistant_parts = []
+        self.chat_history.append({"sender": "Assistant", "message": message})
+        self._unsaved_count += 1
+        self._save_chat_history()
     
     def explain_code(self, code: str):
         """コードを説明（外部から呼ばれる）"""
@@ -569,9 +699,7 @@ Based on this context, {message}"""
         if editor:
             filename = editor.get_filename()
             if filename:
-                file_ext = Path(filename).suffix.lower()
-                lang_map = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.cpp': 'cpp', '.c': 'c'}
-                lang = lang_map.get(file_ext, 'python')
+                lang = _LANG_MAP.get(os.path.splitext(filename)[1].lower(), 'python')
         
         # メッセージを作成
         message = f"Please explain this code:\n```{lang}\n{code}\n```"
@@ -593,27 +721,29 @@ Based on this context, {message}"""
             # シェルのテキストウィジェットを取得
             shell_text = shell_view.text
             
-            # シェルの内容を取得（最後の部分）
-            shell_content = shell_text.get("1.0", tk.END)
-            lines = shell_content.strip().split('\n')
-            
-            # エラーを探す（後ろから検索）
+            # エラーを探す（シェル全体は取得せず、末尾から1行ずつ遡る）
             error_lines = []
             error_found = False
             
-            for i in range(len(lines) - 1, -1, -1):
-                line = lines[i]
+            last_line = int(shell_text.index("end-1c").split(".")[0])
+            first_line = max(1, last_line - MAX_ERROR_SCAN_LINES)
+            
+            for line_no in range(last_line, first_line - 1, -1):
+                line = shell_text.get(f"{line_no}.0", f"{line_no}.0 lineend")
                 
                 # エラーの終わりを検出
                 if error_found and (line.startswith(">>>") or line.startswith("===") or not line.strip()):
                     break
                 
                 # エラーパターンを検出
-                if any(error_type in line for error_type in ["Error", "Exception", "Traceback"]):
+                if any(tok in line for tok in ERROR_TOKENS):
                     error_found = True
                 
                 if error_found:
-                    error_lines.insert(0, line)
+                    error_lines.append(line)
+            
+            # 後ろから集めたので最後に一度だけ反転
+            error_lines.reverse()
             
             if not error_lines:
                 messagebox.showinfo("No Error", "No recent error found in shell.")
@@ -665,6 +795,8 @@ Based on this context, {message}"""
         
         # 履歴もクリア
         self.chat_history.clear()
+        self._unsaved_count = 0
+        self._rewrite_history = True
         self._save_chat_history()
     
     def _toggle_context(self):
@@ -676,22 +808,42 @@ Based on this context, {message}"""
                 self.context_manager = ContextManager()
     
     def _get_chat_history_path(self) -> Path:
-        """チャット履歴ファイルのパスを取得"""
-        workbench = get_workbench()
-        data_dir = Path(workbench.get_configuration_directory())
-        llm_dir = data_dir / "llm_assistant"
-        llm_dir.mkdir(exist_ok=True)
-        return llm_dir / "chat_history_text.json"
+        """チャット履歴ファイルのパスを取得（初回のみディレクトリを作成）"""
+        if self._history_path is None:
+            workbench = get_workbench()
+            data_dir = Path(workbench.get_configuration_directory())
+            llm_dir = data_dir / "llm_assistant"
+            llm_dir.mkdir(exist_ok=True)
+            self._history_path = llm_dir / "chat_history_text.jsonl"
+        return self._history_path
     
     def _save_chat_history(self):
-        """チャット履歴を保存"""
+        """チャット履歴を保存（通常は未保存の分だけ追記し、行数が増えたら書き直す）"""
         try:
-            # 最新の100メッセージのみ保存
-            messages_to_save = self.chat_history[-100:]
-            
             history_path = self._get_chat_history_path()
-            with open(history_path, 'w', encoding='utf-8') as f:
-                json.dump(messages_to_save, f, ensure_ascii=False, indent=2)
+            
+            # クリアされた場合、または行数が閾値に達した場合は最新分だけで書き直す
+            # （UIスレッドで書き込むので、履歴全体はコピーせず末尾だけを順に書き出す）
+            history = self.chat_history
+            new_count = min(self._unsaved_count, len(history))
+            if (self._rewrite_history
+                    or self._saved_line_count + new_count >= HISTORY_REWRITE_THRESHOLD):
+                messages_to_save = islice(history, max(0, len(history) - HISTORY_KEEP), None)
+                mode = 'w'
+                self._saved_line_count = 0
+            else:
+                messages_to_save = islice(history, len(history) - new_count, None)
+                mode = 'a'
+            
+            written = 0
+            with open(history_path, mode, encoding='utf-8') as f:
+                for msg in messages_to_save:
+                    f.write(json.dumps(msg, ensure_ascii=False) + "\n")
+                    written += 1
+            
+            self._saved_line_count += written
+            self._unsaved_count = 0
+            self._rewrite_history = False
                 
         except Exception as e:
             logger.error(f"Failed to save chat history: {e}")
@@ -700,21 +852,32 @@ Based on this context, {message}"""
         """チャット履歴を読み込む"""
         try:
             history_path = self._get_chat_history_path()
+            saved_messages = []
             if history_path.exists():
+                # 1行ずつ読み込む（壊れた行は読み飛ばす）
                 with open(history_path, 'r', encoding='utf-8') as f:
-                    saved_messages = json.load(f)
-                
-                # 保存されたメッセージを復元
-                for msg in saved_messages:
-                    self._append_message(msg["sender"], msg["message"])
-                    # _append_messageがさらに履歴に追加するのを防ぐため、最後のものを削除
-                    if self.chat_history and self.chat_history[-1] == msg:
-                        self.chat_history.pop()
-                
-                self.chat_history = saved_messages
-                
-                if self.chat_history:
-                    self._append_message("System", "Previous conversation restored", "info")
+                    for line in f:
+                        try:
+                            saved_messages.append(json.loads(line))
+                        except ValueError:
+                            continue
+                self._saved_line_count = len(saved_messages)
+            else:
+                # 旧形式（JSON配列）の履歴があれば読み込み、次回保存時に新形式で書き出す
+                legacy_path = history_path.with_suffix(".json")
+                if legacy_path.exists():
+                    with open(legacy_path, 'r', encoding='utf-8') as f:
+                        saved_messages = json.load(f)
+                    self._rewrite_history = True
+            
+            # 保存されたメッセージを表示（履歴には下でまとめて設定する）
+            for msg in saved_messages:
+                self._append_message(msg["sender"], msg["message"], record=False)
+            
+            self.chat_history = deque(saved_messages, maxlen=MAX_CHAT_HISTORY)
+            
+            if self.chat_history:
+                self._append_message("System", "Previous conversation restored", "info")
                     
         except Exception as e:
             logger.error(f"Failed to load chat history: {e}")
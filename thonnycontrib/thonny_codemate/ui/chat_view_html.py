@@ -7,11 +7,18 @@ from tkinter import ttk, messagebox
 import threading
 import queue
 import logging
+import tempfile
+import os
 import time
 import json
-import traceback
+import hashlib
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
 from pathlib import Path
-from typing import Optional, List, Tuple
+from typing import Optional, Deque
+from urllib.parse import unquote
 
 try:
     from tkinterweb import HtmlFrame
@@ -28,8 +35,17 @@ except ImportError:
     logger = logging.getLogger(__name__)
     logger.addHandler(logging.NullHandler())
 
-from .markdown_renderer import MarkdownRenderer
+from .. import set_llm_busy
 from ..i18n import tr
+from ..prompts import DEFAULT_SYSTEM_PROMPT_TEMPLATE, SKILL_LEVEL_DESCRIPTIONS
+from .chat_view import (
+    _LANG_MAP,
+    ERROR_TOKENS,
+    HISTORY_REWRITE_THRESHOLD,
+    ContextSnapshot,
+    MessageQueueMixin,
+    capture_context,
+)
 
 # パフォーマンスモニタリングを試す（オプショナル）
 try:
@@ -50,12 +66,92 @@ except ImportError:
             pass
 
 
-class LLMChatViewHTML(ttk.Frame):
+# メモリ上に保持する最大メッセージ数（古いものから自動的に破棄）
+MAX_MESSAGES = 200
+
+# キュー処理: 1回あたりの時間予算（秒）
+QUEUE_TIME_BUDGET = 0.008
+# 生成ワーカー側でトークンをまとめる個数と最大の待ち時間（秒、約1フレーム）
+TOKEN_BATCH_SIZE = 8
+TOKEN_BATCH_INTERVAL = 0.016
+
+# ページからの準備完了通知を待つ最大時間（ms、過ぎたらページ再読み込み方式に切り替える）
+HTML_READY_TIMEOUT_MS = 3000
+
+# ストリーミング表示の最大文字数（超えたら先頭から削除、全文は完了後にHTMLビューに表示）
+STREAMING_MAX_CHARS = 20000
+STREAMING_TRIM_CHARS = 5000
+# 同じく行数の上限（超えたら最新STREAMING_KEEP_LINES行だけを残す）
+STREAMING_MAX_LINES = 200
+STREAMING_KEEP_LINES = 150
+
+# ストリーミング表示の最短更新間隔（秒、約30Hz）
+STREAMING_FLUSH_INTERVAL = 0.033
+
+# 履歴保存のデバウンス間隔（ms、最後の変更からこの時間が経ったら保存）
+SAVE_DEBOUNCE_MS = 2000
+
+# 履歴ファイルに保存する最新メッセージ数（書き直すまでに追記できる行数はチャットビューと共通）
+HISTORY_SAVE_LIMIT = 100
+
+# コード説明の応答キャッシュに保持する件数
+RESPONSE_CACHE_SIZE = 32
+
+# エラー説明のプロンプトに含めるエディタのコードの最大文字数
+MAX_EDITOR_CHARS = 8000
+
+# メッセージ表示領域を空にするJavaScript
+_CLEAR_MESSAGES_JS = "document.getElementById('messages').innerHTML = '';"
+
+# スキルレベルごとの指示（コード説明用とエラー説明用）
+SKILL_INSTRUCTIONS = {
+    "beginner": {
+        "explain": "Explain in simple terms for a beginner. Avoid technical jargon and use plain language.",
+        "error": "Explain the error in simple terms for a beginner and provide clear solutions.",
+    },
+    "intermediate": {
+        "explain": "Explain assuming basic programming knowledge.",
+        "error": "Explain the error and solutions assuming basic programming knowledge.",
+    },
+    "advanced": {
+        "explain": "Provide a detailed explanation including algorithmic efficiency and design considerations.",
+        "error": "Provide a technical explanation of the error and efficient solutions.",
+    },
+}
+
+# Insert機能のフォールバック用URLスキーム
+_INSERT_PREFIX = "thonny:insert:"
+_PREFIX_LEN = len(_INSERT_PREFIX)
+
+# ユーザーメッセージに付加される表示用コンテキスト情報の区切り
+_CONTEXT_MARKER = "\n\n[Context:"
+
+
+@dataclass(slots=True)
+class ChatMessage:
+    """チャットメッセージ（clean_textはLLMに渡すコンテキスト除去済みの本文）"""
+    sender: str
+    text: str
+    clean_text: str
+    
+    @classmethod
+    def create(cls, sender: str, text: str, clean_text: Optional[str] = None) -> "ChatMessage":
+        # 本文が分かっている場合（送信時）はそれを使い、読み込んだ履歴の場合のみ表示用テキストから取り出す
+        if clean_text is None:
+            clean_text = text
+            if sender == "user":
+                clean_text = text.partition(_CONTEXT_MARKER)[0]
+        return cls(sender, text, clean_text)
+
+
+class LLMChatViewHTML(MessageQueueMixin, ttk.Frame):
     """
     HTMLベースのLLMチャットインターフェース
     Markdownレンダリングと対話機能を提供
     """
     
+    queue_time_budget = QUEUE_TIME_BUDGET
+    
     def __init__(self, master):
         super().__init__(master)
         
@@ -65,49 +161,133 @@ class LLMChatViewHTML(ttk.Frame):
             return
         
         self.llm_client = None
-        self.markdown_renderer = MarkdownRenderer()
-        self.messages: List[Tuple[str, str]] = []  # [(sender, text), ...]
         
-        # メッセージキュー（スレッド間通信用）
-        self.message_queue = queue.Queue()
+        # Pygmentsを読み込むため、実際に使う場合のみインポート
+        from .markdown_renderer import MarkdownRenderer
+        self.markdown_renderer = MarkdownRenderer()
+        self.messages: Deque[ChatMessage] = deque(maxlen=MAX_MESSAGES)
+        self._message_count = 0  # これまでに追加したメッセージの総数（dequeから破棄された分も含む）
+        self._last_prefix_hash = None  # 前回送信した会話履歴の先頭部分のハッシュ
+        # 保存対象のメッセージ（追加時に絞り込み済み）
+        self._persistable_messages: Deque[dict] = deque(maxlen=HISTORY_SAVE_LIMIT)
+        self._unsaved_count = 0  # _persistable_messagesの末尾のうちファイルに未書き込みの件数
+        self._saved_line_count = 0  # 履歴ファイルの行数
+        self._rewrite_history = False  # 次回保存時にファイルを書き直すか
+        
+        # スレッド間通信用のメッセージキュー
+        self._init_message_queue()
+        
+        # Markdownのレンダリング用ワーカー（1スレッドなので追加順序は保たれる）
+        self._render_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm_render")
+        
+        # 生成用の常駐ワーカー（送信のたびにスレッドを作らない）
+        # 終了時に生成中でもThonnyを待たせないようデーモンスレッドにする
+        self._gen_requests: "queue.Queue" = queue.Queue()
+        self._gen_thread = threading.Thread(
+            target=self._generation_loop, name="llm_generate", daemon=True
+        )
+        self._gen_thread.start()
         self._processing = False
         self._stop_generation = False
+        # 送信はLLMの準備と履歴の復元の両方が済んでから有効にする
+        # （復元前に送ったメッセージが復元した履歴より前に並ばないように）
+        self._llm_ready = False
+        self._history_loaded = False
         self._first_token_received = False  # 最初のトークンを受け取ったか
+        
+        # コード説明の応答キャッシュ（キー -> 応答テキストのLRU）
+        self._response_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._pending_cache_key = None  # 生成中の応答を保存するキー
         self._generating_animation_id = None  # アニメーションのafter ID
         
-        # スレッドセーフティのためのロック
-        self._message_lock = threading.Lock()
-        self._current_message = ""  # ストリーミング中のメッセージ（ロックで保護）
+        # ストリーミング中のメッセージ断片（UIスレッドからのみ触るためロックは不要）
+        self._current_message_parts = []
         
-        # HTMLが完全に読み込まれたかを追跡
+        # HTMLが完全に読み込まれたかを追跡（ページ側からpyHtmlReadyで通知される）
         self._html_ready = False
-        
-        self._init_ui()
-        self._init_llm()
-        
-        # 定期的にキューをチェック
-        self._queue_check_id = self.after(100, self._process_queue)
+        self._html_ready_timeout_id = None
+        # JavaScriptでメッセージを追加できるか（使えない/失敗した場合はページ全体を再読み込み）
+        self._js_enabled = False
+        self._reload_pending = False  # ページの再読み込みを予約済みか
+        self._reload_scroll = False  # 再読み込み後に最下部へスクロールするか
+        # ビューが表示されているか（非表示中はHTMLへの追加を保留する）
+        self._view_visible = True
+        # HTMLの準備完了前またはビュー非表示中に追加されたメッセージ
+        self._deferred_messages = []
+        self._deferred_scroll = False  # 保留中のメッセージにスクロールが必要なものがあるか
+        
+        # 生成中に繰り返し使う翻訳文字列
+        self._refresh_translations()
+        
+        # 通知の世代番号（古い通知の復元を無視するため）
+        self._notif_gen = 0
+        
+        # 生成のたびに参照する設定値（設定ダイアログで変更されたら取得し直す）
+        self._refresh_options()
+        
+        # システムプロンプトのキャッシュ（(設定値のタプル, プロンプト)）
+        self._system_prompt_cache = (None, None)
+        # 説明用プロンプトの設定キャッシュ（(設定値のタプル, 設定)）
+        self._prompt_prefs_cache = (None, None)
+        
+        self._history_path = None  # チャット履歴ファイルのパス（初回取得時に決定）
+        # 履歴保存のデバウンス用
+        self._save_after_id = None
+        # 履歴の読み書き用ワーカー（1スレッドなので書き込みは順番に行われる）
+        self._io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="llm_io")
+        
+        # 一時ファイルのパス（HTMLの土台を保存）
+        self._temp_dir = tempfile.mkdtemp(prefix="thonny_llm_")
         
         # ウィンドウ閉じるイベントをバインド
         self.bind("<Destroy>", self._on_destroy)
         
+        # 表示状態の変化を追跡
+        self.bind("<Map>", self._on_visibility_change)
+        self.bind("<Unmap>", self._on_visibility_change)
+        self.bind("<Visibility>", self._on_visibility_change)
+        
         # 最後の更新時刻（レート制限用）
         self._last_update_time = 0
         self._update_pending = False
         
+        # ストリーミング表示用のトークンバッファ（一定間隔でまとめて表示）
+        self._pending_tokens = []
+        self._flush_scheduled = False
+        self._streaming_chars = 0  # ストリーミング表示中の文字数
+        self._streaming_lines = 0  # ストリーミング表示中の改行数
+        
         # ストリーミングメッセージIDを生成
         self._current_message_id = None
         
-        # 一時ファイルのパス
-        import tempfile
-        self._temp_dir = tempfile.mkdtemp(prefix="thonny_llm_")
-        self._current_html_path = None
+        # EditModeHandlerを初期化
+        self.edit_mode_handler = None
+        
+        # キューや表示状態はUI/LLMの初期化より前に用意する
+        # （_init_llmの時点でメッセージが追加され、ワーカーから通知が来ることがあるため）
+        self._init_ui()
+        self._init_llm()
         
         # 会話履歴を読み込む
         self._load_chat_history()
-        
-        # EditModeHandlerを初期化
-        self.edit_mode_handler = None
+    
+    def _refresh_translations(self):
+        """生成のたびに使う翻訳文字列を取得し直す"""
+        self._tr_send = tr("Send")
+        self._tr_stopped = tr("[Generation stopped by user]")
+        self._tr_assistant = tr("Assistant")
+    
+    def _refresh_options(self):
+        """生成のたびに参照する設定値を取得し直す"""
+        workbench = get_workbench()
+        self._options = {
+            "skill_level": workbench.get_option("llm.skill_level", "beginner"),
+            "language": workbench.get_option("llm.language", "auto"),
+            "custom_system_prompt": workbench.get_option("llm.custom_system_prompt", ""),
+            "max_conversation_history": workbench.get_option("llm.max_conversation_history", 10),
+            "output_language": workbench.get_option("llm.output_language", "auto"),
+            "thonny_language": workbench.get_option("general.language", "en"),
+        }
     
     def _show_fallback_ui(self):
         """tkinterwebが利用できない場合のフォールバックUI"""
@@ -198,12 +378,11 @@ class LLMChatViewHTML(ttk.Frame):
         # JavaScriptインターフェースを設定（HTML読み込み前に登録）
         self._setup_js_interface()
         
-        # 初期HTMLを設定
-        self._update_html(full_reload=True)
+        # run_javascriptがないtkinterwebではメッセージのたびにページ全体を読み込み直す
+        self._js_enabled = callable(getattr(self.html_frame, "run_javascript", None))
         
-        # 初期状態では空のHTMLなのですぐに準備完了とみなす
-        if not self.messages:
-            self._html_ready = True
+        # HTMLの土台を一度だけ読み込む（以降の変更はすべてJavaScriptで行う）
+        self._load_shell_html()
     
     def _create_streaming_frame(self):
         """ストリーミング表示エリアを作成"""
@@ -275,7 +454,7 @@ class LLMChatViewHTML(ttk.Frame):
         # Sendボタン
         self.send_button = ttk.Button(
             button_frame,
-            text=tr("Send"),
+            text=self._tr_send,
             command=self._handle_send_button,
             state=tk.DISABLED
         )
@@ -324,10 +503,19 @@ class LLMChatViewHTML(ttk.Frame):
         
         # タイプに応じて色を設定
         color = "green" if notification_type == "success" else "red"
-        self.status_label.config(text=message, foreground=color)
+        self._set_status(message, color)
+        gen = self._notif_gen
         
-        # 2秒後に元に戻す
-        self.after(2000, lambda: self.status_label.config(text=original_text, foreground=original_color))
+        # 2秒後に元に戻す（その間に別の表示に変わっていれば何もしない）
+        def restore():
+            if self._notif_gen == gen:
+                self._set_status(original_text, original_color)
+        self.after(2000, restore)
+    
+    def _set_status(self, text, color):
+        """ステータスラベルを更新（保留中の通知の復元は無効になる）"""
+        self._notif_gen += 1
+        self.status_label.config(text=text, foreground=color)
     
     def _setup_js_interface(self):
         """JavaScriptとのインターフェースを設定"""
@@ -335,6 +523,7 @@ class LLMChatViewHTML(ttk.Frame):
             # Python関数をJavaScriptから呼び出せるように登録
             self.html_frame.register_JS_object("pyInsertCode", self._insert_code)
             self.html_frame.register_JS_object("pyCopyCode", self._copy_code)
+            self.html_frame.register_JS_object("pyHtmlReady", self._on_html_ready)
             logger.info("JavaScript API registered successfully")
         except Exception as e:
             logger.error(f"Failed to setup JavaScript interface: {e}")
@@ -362,7 +551,7 @@ class LLMChatViewHTML(ttk.Frame):
         try:
             self.clipboard_clear()
             self.clipboard_append(code)
-            self.update()
+            # Tkはウィジェットが破棄されるまで選択を保持するため、フラッシュは不要
             return True
         except Exception as e:
             logger.error(f"Error copying code: {e}")
@@ -370,148 +559,250 @@ class LLMChatViewHTML(ttk.Frame):
     
     def _handle_url_change(self, url):
         """URL変更を処理（Insert機能用）"""
-        if url.startswith("thonny:insert:"):
-            import urllib.parse
-            code = urllib.parse.unquote(url[14:])
-            
-            workbench = get_workbench()
-            editor = workbench.get_editor_notebook().get_current_editor()
-            if editor:
-                text_widget = editor.get_text_widget()
-                text_widget.insert("insert", code)
-                text_widget.focus_set()
-                self._show_notification(tr("Code inserted into editor!"))
-            else:
-                messagebox.showinfo(tr("No Editor"), tr("Please open a file in the editor first."))
-            
-            # URLをリセットするため、空のページに戻す
-            # HTMLの再読み込みは避ける（ボタンが使えなくなるため）
-            try:
-                self.html_frame.stop()  # 現在のナビゲーションを停止
-            except:
-                pass
+        if not url.startswith(_INSERT_PREFIX):
+            return True  # すべてのナビゲーションをキャンセル
         
-        return True  # すべてのナビゲーションをキャンセル
-    
-    @measure_performance("chat_view.update_html")
-    def _update_html(self, full_reload=True):
-        """HTMLコンテンツを更新"""
-        if full_reload:
-            # 完全な再読み込み（初回やクリア時）
-            self._html_ready = False
-            html_content = self.markdown_renderer.get_full_html(self.messages)
-            
-            # HTMLを読み込み（HTML内のJavaScriptで自動的に表示される）
-            self.html_frame.load_html(html_content)
-            
-            # HTMLの読み込み完了を待つためのチェック
-            self.after(100, self._check_html_ready)
-            
-            # スクロール管理システムを初期化（HTMLロード後）
-            self.after(200, lambda: self._init_scroll_manager() if not hasattr(self, '_scroll_manager_initialized') else None)
-            
-            # 完全読み込み後にスクロール（初回のみ）
-            if not self.messages or len(self.messages) <= 1:
-                self._scroll_to_bottom()
+        code = unquote(url[_PREFIX_LEN:])
+        
+        workbench = get_workbench()
+        editor = workbench.get_editor_notebook().get_current_editor()
+        if editor:
+            text_widget = editor.get_text_widget()
+            text_widget.insert("insert", code)
+            text_widget.focus_set()
+            self._show_notification(tr("Code inserted into editor!"))
         else:
-            # ストリーミング中は何もしない（ストリーミングテキストエリアで表示）
+            messagebox.showinfo(tr("No Editor"), tr("Please open a file in the editor first."))
+        
+        # URLをリセットするため、空のページに戻す
+        # HTMLの再読み込みは避ける（ボタンが使えなくなるため）
+        try:
+            self.html_frame.stop()  # 現在のナビゲーションを停止
+        except:
             pass
+        
+        return True  # すべてのナビゲーションをキャンセル
     
-    def _update_last_message_js(self, message_html):
-        """JavaScriptで最後のメッセージのみ更新"""
-        # 新しいアプローチでは使用しない
-        pass
+    @measure_performance("chat_view.load_shell_html")
+    def _load_shell_html(self):
+        """メッセージを含まないHTMLの土台をファイルに書き出して読み込む（ビュー生成時の一度のみ）"""
+        if not self._js_enabled:
+            # JavaScriptが使えない場合は準備完了の通知も来ないため、そのまま読み込んで完了とする
+            self.html_frame.load_html(self.markdown_renderer.get_full_html([]))
+            self._html_ready = True
+            return
+        
+        self._html_ready = False
+        shell_path = Path(self._temp_dir) / "shell.html"
+        shell_path.write_text(self.markdown_renderer.get_full_html([]), encoding="utf-8")
+        
+        # 準備完了の通知が来ない場合に備えた安全タイムアウト
+        self._html_ready_timeout_id = self.after(HTML_READY_TIMEOUT_MS, self._on_html_ready_timeout)
+        
+        # HTMLを読み込み（DOM構築後にページ側からpyHtmlReadyが呼ばれる）
+        self.html_frame.load_file(str(shell_path))
+        
+        # load_fileは同期的に読み込むので、通知処理をこちらからも呼んで実行できるか確かめる
+        # （通知済みなら何もしない。実行できなければすぐに再読み込み方式へ切り替える）
+        try:
+            self.html_frame.run_javascript("notifyReady();")
+        except Exception as e:
+            logger.warning(f"JavaScript is not available, reloading the page for each update: {e}")
+            self._disable_javascript()
     
-    @measure_performance("chat_view.append_message_js")
     def _append_message_js(self, sender: str, text: str):
-        """JavaScriptで新しいメッセージを追加"""
+        """JavaScriptで新しいメッセージを追加（ページの再読み込みは行わない）"""
+        # ユーザーメッセージまたはシステムメッセージ（Edit mode）の場合は追加後にスクロール
+        self._append_messages_js([(sender, text)], scroll=sender in ("user", "system"))
+    
+    def _append_messages_js(self, batch: list, scroll: bool = True):
+        """複数メッセージを1回のJavaScript呼び出しでまとめて追加"""
+        if not batch:
+            return
+        # HTMLが準備できていない場合やビューが非表示の場合は後でまとめて追加
+        if not self._html_ready or not self._view_visible:
+            self._deferred_messages.extend(batch)
+            self._deferred_scroll = self._deferred_scroll or scroll
+            return
+        if not self._js_enabled:
+            # メッセージはself.messagesに追加済みなので、ページ全体から描画し直す
+            self._request_reload(scroll)
+            return
+        self._submit_render(batch, scroll)
+    
+    def _flush_deferred_messages(self):
+        """保留中のメッセージを1回のJavaScript呼び出しで追加"""
+        if not self._deferred_messages:
+            return
+        deferred, self._deferred_messages = self._deferred_messages, []
+        scroll, self._deferred_scroll = self._deferred_scroll, False
+        self._append_messages_js(deferred, scroll=scroll)
+    
+    def _on_visibility_change(self, event):
+        """ビューの表示状態が変わった時に呼ばれる"""
+        if event.type == tk.EventType.Unmap:
+            self._view_visible = False
+        elif event.type == tk.EventType.Map:
+            self._view_visible = True
+        else:
+            # Visibilityイベントは送られない環境（Windowsなど）があるため、
+            # 表示への復帰はMapでも必ず行われるようにしている
+            self._view_visible = event.state != "VisibilityFullyObscured"
+        
+        if self._view_visible:
+            self._flush_deferred_messages()
+    
+    def _submit_render(self, messages: list, scroll: bool = False):
+        """レンダリングとエスケープをワーカースレッドで行い、結果はキュー経由でUIスレッドに渡す"""
+        future = self._render_pool.submit(self._build_append_js, messages)
+        future.add_done_callback(lambda f: self._on_render_done(f, scroll))
+    
+    def _clear_messages_js(self):
+        """表示中のメッセージをJavaScriptで消去（JavaScriptが使えない場合はページを読み込み直す）"""
+        self._deferred_messages = []
+        self._deferred_scroll = False
+        if not self._html_ready:
+            return
+        if not self._js_enabled:
+            # self.messagesは消去済みなので、空のページが読み込まれる
+            self._request_reload()
+            return
+        # レンダリング待ちのメッセージより後に実行されるようワーカー経由で渡す
+        future = self._render_pool.submit(lambda: _CLEAR_MESSAGES_JS)
+        future.add_done_callback(lambda f: self._on_render_done(f, False))
+    
+    def _on_render_done(self, future, scroll: bool):
+        """レンダリング完了時のコールバック（ワーカースレッドで呼ばれる）"""
         try:
-            # HTMLが準備できていない場合は全体更新
-            if not self._html_ready:
-                self._update_html(full_reload=True)
-                return
-            
-            # HTMLを生成
-            message_html = self.markdown_renderer.render(text, sender)
-            
-            # HTMLをJavaScript文字列としてエスケープ
-            escaped_html = (message_html
-                .replace('\\', '\\\\')
-                .replace('\n', '\\n')
-                .replace('\r', '\\r')
-                .replace('"', '\\"')
-                .replace('</script>', '<\\/script>'))
-            
-            js_code = f"""
-            (function() {{
-                var messagesDiv = document.getElementById('messages');
-                if (!messagesDiv) {{
-                    console.error('Messages container not found');
-                    return false;
-                }}
-                
-                // 新しいメッセージを追加
-                messagesDiv.insertAdjacentHTML('beforeend', "{escaped_html}");
-                return true;
-            }})();
-            """
-            result = self.html_frame.run_javascript(js_code)
-            
-            # JavaScriptの実行に失敗した場合は全体更新
-            if not result:
-                self._update_html(full_reload=True)
-            
+            js_code = future.result()
         except Exception as e:
-            logger.error(f"Could not append message: {e}")
-            # エラーの場合はフォールバックとして完全更新
-            self._update_html(full_reload=True)
+            logger.error(f"Could not render message: {e}")
+            return
+        self._post(("js", (js_code, scroll)))
     
+    @measure_performance("chat_view.build_append_js")
+    def _build_append_js(self, messages: list) -> str:
+        """メッセージ群をDOMの末尾に一度で追加するJavaScriptを生成（ワーカースレッドで実行）"""
+        message_html = "".join(
+            self.markdown_renderer.render(text, sender) for sender, text in messages
+        )
+        
+        # HTMLをJavaScript文字列としてエスケープ
+        # json.dumpsは制御文字やU+2028/U+2029も含めて正しくエスケープする
+        html_literal = json.dumps(message_html).replace('</', '<\\/')
+        
+        # 関数本体はページ側で定義済みなので、呼び出しと引数だけを送る
+        return f"appendMessages({html_literal});"
     
-    def _check_html_ready(self):
-        """HTMLの読み込み完了をチェック"""
-        # タイムアウト設定（10秒）
-        if not hasattr(self, '_html_ready_check_count'):
-            self._html_ready_check_count = 0
+    def _run_append_js(self, js_code: str, scroll: bool):
+        """生成済みのJavaScriptを実行してメッセージを追加（UIスレッド）"""
+        if not self._js_enabled:
+            # 切り替え前にレンダリング済みだった分は再読み込みで表示する
+            self._request_reload(scroll)
+            return
         
-        self._html_ready_check_count += 1
-        if self._html_ready_check_count > 200:  # 50ms * 200 = 10秒
-            logger.warning("HTML ready check timeout - proceeding anyway")
-            self._html_ready = True
+        # 追加前に最下部を表示していた場合のみ追従する（読み返し中は動かさない）
+        at_bottom = self._is_at_bottom()
+        try:
+            self.html_frame.run_javascript(js_code)
+        except Exception as e:
+            # JavaScriptが使えない環境では以降もページ全体の再読み込みで表示する
+            logger.warning(f"Could not append message with JavaScript, reloading the page instead: {e}")
+            self._disable_javascript()
+            self._request_reload(scroll)
             return
         
+        if scroll or at_bottom:
+            # 追加したHTMLのレイアウトを確定させてから即座にスクロール
+            self.update_idletasks()
+            self._scroll_to_bottom()
+    
+    def _request_reload(self, scroll: bool = False):
+        """ページ全体の再読み込みを予約（続けて追加されたメッセージは1回の再読み込みにまとめる）"""
+        self._reload_scroll = self._reload_scroll or scroll
+        if not self._reload_pending:
+            self._reload_pending = True
+            self.after_idle(self._reload_html)
+    
+    def _reload_html(self):
+        """全メッセージからHTMLを生成し直す（レンダリングはワーカースレッドで行う）"""
+        self._reload_pending = False
+        scroll, self._reload_scroll = self._reload_scroll, False
+        # 描画済みのメッセージはレンダラーのキャッシュから返るため、変換されるのは新しいものだけ
+        snapshot = [(msg.sender, msg.text) for msg in self.messages]
+        future = self._render_pool.submit(self.markdown_renderer.get_full_html, snapshot)
+        future.add_done_callback(lambda f: self._on_page_rendered(f, scroll))
+    
+    def _on_page_rendered(self, future, scroll: bool):
+        """ページ全体のレンダリング完了時のコールバック（ワーカースレッドで呼ばれる）"""
         try:
-            # JavaScriptでDOMの準備状態をチェック
-            js_code = """
-            (function() {
-                return document.readyState === 'complete' && 
-                       document.getElementById('messages') !== null &&
-                       typeof pyInsertCode !== 'undefined' &&
-                       typeof pyCopyCode !== 'undefined' &&
-                       window.pageReady === true;
-            })();
-            """
-            result = self.html_frame.run_javascript(js_code)
-            if result:
-                self._html_ready = True
-                logger.debug("HTML is ready")
-                # HTMLが準備完了したらスクロール管理システムを初期化
-                if not hasattr(self, '_scroll_manager_initialized'):
-                    self._init_scroll_manager()
-                    self._scroll_manager_initialized = True
-            else:
-                # まだ準備ができていない場合は再チェック
-                self.after(50, self._check_html_ready)
+            html_content = future.result()
         except Exception as e:
-            logger.debug(f"HTML readiness check error: {e}")
-            # エラーの場合も再チェック（タイムアウトまで）
-            if self._html_ready_check_count < 200:
-                self.after(50, self._check_html_ready)
-    
+            logger.error(f"Could not render messages: {e}")
+            return
+        self._post(("page", (html_content, scroll)))
     
-    def _init_scroll_manager(self):
-        """JavaScriptスクロール管理システムを初期化"""
-        # シンプルなスクロール管理
-        pass
+    @measure_performance("chat_view.load_page")
+    def _load_page(self, html_content: str, scroll: bool):
+        """生成済みのHTMLでページを読み込み直す（UIスレッド）"""
+        at_bottom = self._is_at_bottom()
+        try:
+            top = float(self.tk.splitlist(self.html_frame.html.yview())[0])
+        except Exception:
+            top = 0.0
+        
+        try:
+            self.html_frame.load_html(html_content)
+        except Exception as e:
+            logger.error(f"Could not load chat HTML: {e}")
+            return
+        
+        self.update_idletasks()
+        if scroll or at_bottom:
+            self._scroll_to_bottom()
+        else:
+            # 読み返し中だった場合は元の位置に戻す
+            self.html_frame.yview_moveto(top)
+    
+    def _on_html_ready(self):
+        """ページのDOM構築完了時にJavaScriptから呼ばれる"""
+        if self._html_ready_timeout_id:
+            self.after_cancel(self._html_ready_timeout_id)
+            self._html_ready_timeout_id = None
+        
+        self._html_ready = True
+        logger.debug("HTML is ready")
+        
+        # 準備完了前に追加されたメッセージをまとめて描画
+        self._flush_deferred_messages()
+    
+    def _on_html_ready_timeout(self):
+        """準備完了の通知が来なかった場合はJavaScriptを使わない表示に切り替える"""
+        self._html_ready_timeout_id = None
+        if not self._html_ready:
+            logger.warning("HTML ready notification timeout - falling back to full page reloads")
+            self._disable_javascript()
+    
+    def _disable_javascript(self):
+        """JavaScriptでの更新をやめ、以降はページ全体の再読み込みで表示する"""
+        self._js_enabled = False
+        if self._html_ready_timeout_id:
+            self.after_cancel(self._html_ready_timeout_id)
+            self._html_ready_timeout_id = None
+        
+        # 再読み込みは通知を待たずにいつでも行える
+        self._html_ready = True
+        # 準備完了前に追加されたメッセージは再読み込みでまとめて表示
+        self._flush_deferred_messages()
+    
+    def _is_at_bottom(self) -> bool:
+        """HTMLビューが最下部付近を表示しているか"""
+        try:
+            _, last = self.tk.splitlist(self.html_frame.html.yview())
+            return float(last) >= 0.98
+        except Exception:
+            # 位置が取得できない場合は従来どおり追従する
+            return True
     
     def _scroll_to_bottom(self):
         """HTMLフレームを最下部にスクロール"""
@@ -546,7 +837,7 @@ class LLMChatViewHTML(ttk.Frame):
                         workbench.set_option("llm.model_path", available_model)
                         model_path = available_model
                     else:
-                        self.status_label.config(text=tr("No model loaded"), foreground="red")
+                        self._set_status(tr("No model loaded"), "red")
                         self._add_message(
                             "system",
                             tr("No model found. Please download a model from Settings → Download Models.")
@@ -561,8 +852,8 @@ class LLMChatViewHTML(ttk.Frame):
                         return
                 
                 # 非同期でモデルをロード
-                model_name = Path(model_path).name if model_path else "model"
-                self.status_label.config(text=f"{tr('Loading')} {model_name}...", foreground="orange")
+                self._model_display_name = Path(model_path).name or "model"
+                self._set_status(f"{tr('Loading')} {self._model_display_name}...", "orange")
                 self.llm_client.load_model_async(callback=self._on_model_loaded)
             else:
                 # 外部プロバイダーの場合
@@ -570,19 +861,18 @@ class LLMChatViewHTML(ttk.Frame):
                 # 表示用のプロバイダー名
                 display_provider = "Ollama/LM Studio" if provider == "ollama" else provider
                 display_text = f"{external_model} ({display_provider})" if external_model else f"Using {display_provider}"
-                self.status_label.config(text=display_text, foreground="blue")
+                self._set_status(display_text, "blue")
                 self.llm_client.get_config()
-                self.send_button.config(state=tk.NORMAL)
+                self._llm_ready = True
+                self._update_send_button()
                 self._add_message(
                     "system",
                     tr("Connected to {} API. Ready to chat!").format(display_provider.upper())
                 )
         
         except Exception as e:
-            import traceback
-            error_details = traceback.format_exc()
-            logger.error(f"Failed to initialize LLM client: {e}\n{error_details}")
-            self.status_label.config(text="Error loading model", foreground="red")
+            self._log_error_async(f"Failed to initialize LLM client: {e}", e)
+            self._set_status("Error loading model", "red")
             # ユーザーフレンドリーなエラーメッセージ
             if "import" in str(e).lower():
                 user_message = tr("LLM module not installed. Please install llama-cpp-python.")
@@ -594,61 +884,61 @@ class LLMChatViewHTML(ttk.Frame):
         """モデル読み込み完了時のコールバック"""
         def update_ui():
             if success:
-                model_path = get_workbench().get_option("llm.model_path", "")
-                model_name = Path(model_path).name if model_path else "Unknown"
-                self.status_label.config(text=f"{model_name} | {tr('Ready')}", foreground="green")
-                self.send_button.config(state=tk.NORMAL)
+                self._set_status(f"{self._model_display_name} | {tr('Ready')}", "green")
+                self._llm_ready = True
+                self._update_send_button()
                 self._add_message("system", tr("LLM model loaded successfully!"))
             else:
-                self.status_label.config(text=tr("Load failed"), foreground="red")
+                self._set_status(tr("Load failed"), "red")
                 self._add_message("system", f"{tr('Failed to load model:')} {error}")
         
         self.after(0, update_ui)
     
-    def _add_message(self, sender: str, text: str):
+    def _update_send_button(self):
+        """LLMの準備と履歴の復元が済んでいれば送信ボタンを有効にする"""
+        if self._llm_ready and self._history_loaded and not self._processing:
+            self.send_button.config(state=tk.NORMAL)
+    
+    def _record_message(self, sender: str, text: str, clean_text: Optional[str] = None):
+        """メッセージをリストに追加（dequeのmaxlenにより古いメッセージは自動的に破棄される）"""
+        self.messages.append(ChatMessage.create(sender, text, clean_text))
+        self._message_count += 1
+        if self._is_persistable(sender, text):
+            self._persistable_messages.append({"sender": sender, "text": text})
+            self._unsaved_count += 1
+    
+    @staticmethod
+    def _is_persistable(sender: str, text: str) -> bool:
+        """履歴ファイルに保存するメッセージか（システムの状態メッセージ（"["で始まるもの）は保存しない）"""
+        return sender != "system" or not text.startswith("[")
+    
+    def _add_message(self, sender: str, text: str, clean_text: Optional[str] = None):
         """メッセージを追加してHTMLを更新"""
-        # メッセージ履歴の上限を設定（メモリ使用量を制限）
-        MAX_MESSAGES = 200  # メモリ上の最大メッセージ数
-        
-        self.messages.append((sender, text))
-        
-        # 古いメッセージを削除（最新のMAX_MESSAGES件のみ保持）
-        if len(self.messages) > MAX_MESSAGES:
-            # 最初の10%を削除してパフォーマンスを向上
-            remove_count = max(1, MAX_MESSAGES // 10)
-            self.messages = self.messages[remove_count:]
-            logger.debug(f"Trimmed {remove_count} old messages from memory")
-        
-        # HTMLが準備できているかチェックしてメッセージを追加
-        if self._html_ready:
-            # JavaScriptで新しいメッセージを追加（全体再読み込みを避ける）
-            self._append_message_js(sender, text)
-            # ユーザーメッセージまたはシステムメッセージ（Edit mode）の場合にスクロール
-            if sender in ["user", "system"]:
-                self._scroll_to_bottom()
-        else:
-            # HTMLが準備できていない場合は、準備完了を待ってから追加
-            self._add_message_when_ready(sender, text)
+        self._record_message(sender, text, clean_text)
+        
+        # JavaScriptで新しいメッセージを追加（HTMLの準備ができていなければ準備完了を待つ）
+        self._append_message_js(sender, text)
         
         # ユーザーとアシスタントのメッセージのみ保存（システムメッセージは一時的なものが多いため）
         if sender in ["user", "assistant"]:
-            self._save_chat_history()
-    
-    def _add_message_when_ready(self, sender: str, text: str, retry_count=0):
-        """HTMLが準備できたらメッセージを追加（既にメッセージリストには追加済み）"""
-        if self._html_ready:
-            # JavaScriptで新しいメッセージを追加
-            self._append_message_js(sender, text)
-            # ユーザーメッセージまたはシステムメッセージ（Edit mode）の場合にスクロール
-            if sender in ["user", "system"]:
-                self._scroll_to_bottom()
-        else:
-            # まだ準備ができていない場合は再試行（最大100回）
-            if retry_count < 100:
-                self.after(50, lambda: self._add_message_when_ready(sender, text, retry_count + 1))
-            else:
-                # タイムアウト時は全体を再読み込み
-                self._update_html(full_reload=True)
+            self._schedule_save()
+    
+    def _add_messages(self, messages: list, save: bool = True):
+        """複数のメッセージをまとめて追加（HTMLへの追加は1回のJavaScript呼び出し）
+        
+        Args:
+            messages: [(sender, text), ...] のリスト
+            save: ユーザー/アシスタントのメッセージが含まれる場合に保存を予約するか
+        """
+        if not messages:
+            return
+        for sender, text in messages:
+            self._record_message(sender, text)
+        
+        self._append_messages_js(messages)
+        
+        if save and any(sender in ("user", "assistant") for sender, _ in messages):
+            self._schedule_save()
     
     def _handle_send_button(self):
         """送信/停止ボタンのハンドラー"""
@@ -668,6 +958,10 @@ class LLMChatViewHTML(ttk.Frame):
     
     def _send_message(self):
         """メッセージを送信"""
+        # 履歴の復元前は送信しない（Ctrl+Enterや説明機能からの呼び出しも含む）
+        if not self._history_loaded:
+            return
+        
         message = self.input_text.get("1.0", tk.END).strip()
         if not message:
             return
@@ -682,41 +976,31 @@ class LLMChatViewHTML(ttk.Frame):
         
         # Chat mode（通常の処理）
         # コンテキスト情報を取得して表示メッセージを作成
-        context_info = self._get_context_info()
+        # （エディタへのアクセスはここで一度だけ行う）
+        snapshot = self._capture_context()
+        context_info = f"Context: {snapshot.describe()}" if snapshot else None
         display_message = self._format_display_message(message, context_info)
         
         # ユーザーメッセージを追加
-        self._add_message("user", display_message)
+        self._add_message("user", display_message, clean_text=message)
         
-        # ユーザーメッセージ追加後に最下部にスクロール
-        self.after(100, self._scroll_to_bottom)
+        # コンテキスト文字列もUIスレッドで組み立てておく（ワーカーからTkに触れない）
+        context_str = snapshot.format() if snapshot else None
         
         # 生成を開始
-        self._start_generation(message)
+        self._start_generation(message, context_str)
     
-    def _get_context_info(self) -> Optional[str]:
-        """コンテキスト情報を取得"""
+    def _capture_context(self) -> Optional[ContextSnapshot]:
+        """エディタのコンテキストを取得（UIスレッドから呼ぶこと）"""
         if not (self.context_var.get() and self.context_manager):
             return None
         
-        workbench = get_workbench()
-        editor = workbench.get_editor_notebook().get_current_editor()
+        editor = get_workbench().get_editor_notebook().get_current_editor()
         if not editor:
             return None
         
-        current_file = editor.get_filename()
-        text_widget = editor.get_text_widget()
-        
-        if text_widget.tag_ranges("sel"):
-            # 選択範囲がある場合
-            start_line = int(text_widget.index("sel.first").split(".")[0])
-            end_line = int(text_widget.index("sel.last").split(".")[0])
-            file_name = Path(current_file).name if current_file else "Untitled"
-            return f"Context: {file_name} (lines {start_line}-{end_line})"
-        else:
-            # ファイル全体の場合（未保存ファイルも含む）
-            file_name = Path(current_file).name if current_file else "Untitled"
-            return f"Context: {file_name} (entire file)"
+        # 未保存ファイルも含めて取得
+        return capture_context(editor)
     
     def _format_display_message(self, message: str, context_info: Optional[str]) -> str:
         """表示用メッセージをフォーマット"""
@@ -724,55 +1008,62 @@ class LLMChatViewHTML(ttk.Frame):
             return f"{message}\n\n[{context_info}]"
         return message
     
-    def _start_generation(self, message: str):
+    def _start_generation(self, message: str, context_str: Optional[str] = None):
         """生成処理を開始"""
         # 処理中フラグを設定
         self._processing = True
-        with self._message_lock:
-            self._current_message = ""
+        self._current_message_parts = []
         self._stop_generation = False
         self._first_token_received = False
         self.send_button.config(text="Stop", state=tk.NORMAL)
         
         # 新しいメッセージIDを生成
-        import time
-        self._current_message_id = f"msg_{int(time.time() * 1000)}"
+        self._current_message_id = f"msg_{time.monotonic_ns() // 1_000_000}"
         
         # グローバルの生成状態を更新
-        from .. import set_llm_busy
         set_llm_busy(True)
         
         # "Generating..."アニメーションを開始
         self._start_generating_animation()
         
-        # バックグラウンドで処理
-        thread = threading.Thread(
-            target=self._generate_response,
-            args=(message,),  # 元のメッセージを渡す（コンテキスト情報なし）
-            daemon=True
-        )
-        thread.start()
+        # バックグラウンドで処理（元のメッセージと組み立て済みのコンテキストを渡す）
+        self._gen_requests.put((self._generate_response, (message, context_str)))
+    
+    def _generation_loop(self):
+        """生成リクエストを順に処理する（常駐ワーカースレッドで実行）"""
+        while True:
+            request = self._gen_requests.get()
+            if request is None:
+                return
+            func, args = request
+            try:
+                func(*args)
+            except Exception as e:
+                # 各処理内でエラーは報告済みだが、ワーカーが止まらないようにする
+                logger.error(f"Unhandled error in generation worker: {e}")
     
     def _get_system_prompt(self) -> str:
         """スキルレベルと言語設定に応じたシステムプロンプトを生成（フォーマット文字列置換付き）"""
-        workbench = get_workbench()
-        
         # 設定値を取得
-        skill_level_setting = workbench.get_option("llm.skill_level", "beginner")
-        language_setting = workbench.get_option("llm.language", "auto")
-        custom_prompt = workbench.get_option("llm.custom_system_prompt", "")
+        options = self._options
+        skill_level_setting = options["skill_level"]
+        language_setting = options["language"]
+        custom_prompt = options["custom_system_prompt"]
+        
+        # 設定が前回と同じならキャッシュを返す
+        key = (skill_level_setting, language_setting, custom_prompt)
+        cached_key, cached_prompt = self._system_prompt_cache
+        if cached_key == key:
+            return cached_prompt
         
         # カスタムプロンプトが設定されている場合はそれを使用
         if custom_prompt.strip():
             template = custom_prompt
         else:
             # デフォルトテンプレート（共通定数から取得）
-            from ..prompts import DEFAULT_SYSTEM_PROMPT_TEMPLATE
             template = DEFAULT_SYSTEM_PROMPT_TEMPLATE
         
         # スキルレベルの詳細説明を生成（共通定数から取得）
-        from ..prompts import SKILL_LEVEL_DESCRIPTIONS
-        
         skill_level_detailed = SKILL_LEVEL_DESCRIPTIONS.get(skill_level_setting, skill_level_setting)
         
         # フォーマット文字列を置換
@@ -781,10 +1072,12 @@ class LLMChatViewHTML(ttk.Frame):
                 skill_level=skill_level_detailed,
                 language=language_setting
             )
-            return formatted_prompt
         except KeyError as e:
             # フォーマット文字列にエラーがある場合はそのまま返す
-            return template
+            formatted_prompt = template
+        
+        self._system_prompt_cache = (key, formatted_prompt)
+        return formatted_prompt
     
     def _prepare_conversation_history(self) -> list:
         """会話履歴をLLM用の形式に変換（システムプロンプト付き）"""
@@ -795,34 +1088,47 @@ class LLMChatViewHTML(ttk.Frame):
         history.append({"role": "system", "content": system_prompt})
         
         # 最新の会話履歴から適切な数だけ取得（メモリ制限のため）
-        workbench = get_workbench()
-        max_history = workbench.get_option("llm.max_conversation_history", 10)  # デフォルト10ターン
+        max_history = self._options["max_conversation_history"]  # デフォルト10ターン
         
         # 現在生成中の場合、最新のユーザーメッセージは除外する
-        messages_to_process = self.messages[:-1] if self._processing else self.messages
-        
-        for sender, text in messages_to_process[-max_history:]:
-            if sender == "user":
-                # コンテキスト情報を除去（[Context: ...]の部分）
-                clean_text = text
-                if "\n\n[Context:" in text:
-                    clean_text = text.split("\n\n[Context:")[0]
-                history.append({"role": "user", "content": clean_text})
-            elif sender == "assistant":
-                history.append({"role": "assistant", "content": text})
+        base = self._message_count - len(self.messages)  # self.messages[0]の通し番号
+        end = self._message_count - (1 if self._processing else 0)
+        
+        # 履歴の先頭はmax_historyの半分単位でしか進めない
+        # （毎ターン先頭が変わるとLLM側のプロンプトキャッシュが使えなくなるため）
+        # 先頭は切り捨てて決めるので、送る件数は設定値を下回らない
+        # （代わりに最大でmax_history // 2 - 1件多く送る）
+        step = max(1, max_history // 2)
+        start = max(0, end - max_history) // step * step
+        # 必要な範囲だけを一度にコピーする（deque全体はコピーしない）
+        # ワーカースレッドで実行されるため、UIスレッドの追加と競合しないよう遅延評価はしない
+        recent_messages = list(islice(self.messages, max(0, start - base), max(0, end - base)))
+        
+        # 先頭部分が前回から変わった場合はキャッシュが再構築される
+        prefix_hash = hash((system_prompt, start))
+        if self._last_prefix_hash is not None and prefix_hash != self._last_prefix_hash:
+            logger.debug("Conversation prefix changed; the LLM will re-process the history")
+        self._last_prefix_hash = prefix_hash
+        
+        for msg in recent_messages:
+            if msg.sender == "user":
+                # コンテキスト情報（[Context: ...]の部分）は追加時に除去済み
+                history.append({"role": "user", "content": msg.clean_text})
+            elif msg.sender == "assistant":
+                history.append({"role": "assistant", "content": msg.text})
             # システムメッセージ（UI上の）は除外（システムプロンプトとは別）
         
         return history
     
-    def _generate_response(self, message: str):
-        """バックグラウンドで応答を生成"""
+    def _generate_response(self, message: str, context_str: Optional[str] = None):
+        """バックグラウンドで応答を生成（Tkには触れない）"""
         try:
             # 最新のLLMクライアントを取得（プロバイダー変更に対応）
             from .. import get_llm_client
             llm_client = get_llm_client()
             
             # プロンプトと会話履歴を準備
-            full_prompt = self._prepare_prompt_with_context(message)
+            full_prompt = self._prepare_prompt_with_context(message, context_str)
             conversation_history = self._prepare_conversation_history()
             
             # ストリーミング生成
@@ -831,12 +1137,8 @@ class LLMChatViewHTML(ttk.Frame):
         except Exception as e:
             self._handle_generation_error(e)
     
-    def _prepare_prompt_with_context(self, message: str) -> str:
+    def _prepare_prompt_with_context(self, message: str, context_str: Optional[str]) -> str:
         """コンテキストを含むプロンプトを準備"""
-        if not (self.context_var.get() and self.context_manager):
-            return message
-        
-        context_str = self._build_context_string()
         if context_str:
             return f"""Here is the context from the current project:
 
@@ -846,134 +1148,121 @@ Based on this context, {message}"""
         
         return message
     
-    def _build_context_string(self) -> Optional[str]:
-        """コンテキスト文字列を構築"""
-        workbench = get_workbench()
-        editor = workbench.get_editor_notebook().get_current_editor()
-        if not editor:
-            return None
-        
-        current_file = editor.get_filename()
-        text_widget = editor.get_text_widget()
-        
-        # 選択範囲のテキストを取得
-        selected_text = self._get_selected_text(text_widget)
-        if selected_text:
-            return self._format_selected_context(current_file, text_widget, selected_text)
-        
-        # 選択範囲がない場合はファイル全体
-        # current_fileがなくても（未保存ファイル）エディタから内容を取得
-        return self._format_full_file_context(current_file, text_widget)
-    
-    def _get_selected_text(self, text_widget) -> Optional[str]:
-        """選択されたテキストを取得"""
-        if text_widget.tag_ranges("sel"):
-            return text_widget.get("sel.first", "sel.last")
-        return None
-    
-    def _format_selected_context(self, current_file: str, text_widget, selected_text: str) -> str:
-        """選択範囲のコンテキストをフォーマット"""
-        start_line = int(text_widget.index("sel.first").split(".")[0])
-        end_line = int(text_widget.index("sel.last").split(".")[0])
-        selection_info = f"Selected lines: {start_line}-{end_line}"
-        
-        lang = self._detect_language(current_file)
-        file_name = Path(current_file).name if current_file else 'Untitled'
-        
-        return f"""File: {file_name}
-{selection_info}
-
-```{lang}
-{selected_text}
-```"""
-    
-    def _format_full_file_context(self, current_file: str, text_widget) -> Optional[str]:
-        """ファイル全体のコンテキストをフォーマット"""
-        full_text = text_widget.get("1.0", tk.END).strip()
-        if not full_text:
-            return None
-        
-        lang = self._detect_language(current_file)
-        file_name = Path(current_file).name if current_file else 'Untitled'
-        
-        return f"""File: {file_name}
-Full file content:
-
-```{lang}
-{full_text}
-```"""
-    
     def _detect_language(self, file_path: str) -> str:
         """ファイル拡張子から言語を検出"""
         if not file_path:
             return 'python'
         
-        file_ext = Path(file_path).suffix.lower()
-        lang_map = {'.py': 'python', '.js': 'javascript', '.java': 'java', '.cpp': 'cpp', '.c': 'c'}
-        return lang_map.get(file_ext, 'python')
+        # Pathオブジェクトを作らずに拡張子を取り出す
+        return _LANG_MAP.get(os.path.splitext(file_path)[1].lower(), 'python')
     
     def _stream_generation(self, llm_client, prompt: str, conversation_history: list):
-        """LLMからストリーミング生成"""
+        """LLMからストリーミング生成（トークンごとに回るホットループ）"""
+        post = self._post  # ループ内での属性参照を避ける
+        monotonic = time.monotonic
+        # トークンはまとめてからキューに送る（数個溜まるか一定時間経ったら送信）
+        buf = []
+        last_post = monotonic()
         for token in llm_client.generate_stream(prompt, messages=conversation_history):
             if self._stop_generation:
-                self.message_queue.put(("complete", None))
-                return
-            self.message_queue.put(("token", token))
+                break
+            buf.append(token)
+            now = monotonic()
+            if len(buf) >= TOKEN_BATCH_SIZE or now - last_post >= TOKEN_BATCH_INTERVAL:
+                post(("token", "".join(buf)))
+                buf.clear()
+                last_post = now
         
-        self.message_queue.put(("complete", None))
+        if buf:
+            post(("token", "".join(buf)))
+        post(("complete", None))
     
     def _handle_generation_error(self, error: Exception):
         """生成エラーを処理"""
-        import traceback
-        error_details = traceback.format_exc()
-        logger.error(f"Error generating response: {error}\n{error_details}")
+        # スタックトレースの整形はログが実際に出力される場合のみlogging側で行う
+        logger.error("Error generating response: %s", error, exc_info=True)
         
         # ユーザーフレンドリーなエラーメッセージ
         from ..utils.error_messages import get_user_friendly_error_message
         user_message = get_user_friendly_error_message(error, "generating response")
-        self.message_queue.put(("error", user_message))
-    
-    def _process_queue(self):
-        """メッセージキューを処理"""
-        try:
-            while True:
-                msg_type, content = self.message_queue.get_nowait()
-                
-                if msg_type == "token":
-                    self._handle_token(content)
-                elif msg_type == "complete":
-                    self._handle_completion()
-                elif msg_type == "edit_complete":
-                    self._handle_edit_completion(content)
-                elif msg_type == "error":
-                    self._handle_error(content)
-                elif msg_type == "info":
-                    self._add_message("system", content)
-            
-        except queue.Empty:
-            pass
-        
-        # 次のチェックをスケジュール
-        self._queue_check_id = self.after(50, self._process_queue)
-    
-    def _handle_token(self, content: str):
+        self._post(("error", user_message))
+    
+    def _handle_queue_message(self, msg_type: str, content):
+        """トークン以外のメッセージを処理"""
+        if msg_type == "complete":
+            self._handle_completion()
+        elif msg_type == "edit_complete":
+            self._handle_edit_completion(content)
+        elif msg_type == "error":
+            self._handle_error(content)
+        elif msg_type == "info":
+            self._add_message("system", content)
+        elif msg_type == "js":
+            self._run_append_js(*content)
+        elif msg_type == "page":
+            self._load_page(*content)
+        elif msg_type == "history":
+            self._apply_loaded_history(content)
+    
+    def _handle_tokens(self, content: str):
         """トークンを処理"""
         # 最初のトークンを受け取ったら準備完了
         if not self._first_token_received:
             self._first_token_received = True
             # ストリーミングフレームのタイトルを更新
-            self.streaming_frame.config(text=tr("Assistant"))
+            self.streaming_frame.config(text=self._tr_assistant)
         
-        with self._message_lock:
-            self._current_message += content
+        self._current_message_parts.append(content)
         
-        # ストリーミングテキストに追加表示
+        # ストリーミングテキストにはまとめて追加表示
+        self._enqueue_token(content)
+    
+    def _enqueue_token(self, content: str):
+        """トークンをバッファに溜め、最大約30Hzでまとめてストリーミング表示に反映"""
+        self._pending_tokens.append(content)
+        if self._flush_scheduled:
+            return
+        
+        wait = STREAMING_FLUSH_INTERVAL - (time.monotonic() - self._last_update_time)
+        if wait <= 0:
+            # 前回の更新から十分に時間が経っていれば（最初のトークンなど）即座に表示
+            self._flush_tokens()
+        else:
+            # 残り時間だけ待ってから、その間に届いたトークンとまとめて表示
+            self._flush_scheduled = True
+            self.after(int(wait * 1000) + 1, self._flush_tokens)
+    
+    def _flush_tokens(self):
+        """バッファ済みのトークンを一度の挿入で表示"""
+        self._flush_scheduled = False
+        if not self._pending_tokens:
+            return
+        
+        content = "".join(self._pending_tokens)
+        self._pending_tokens.clear()
+        self._last_update_time = time.monotonic()
         self._update_streaming_text(content)
     
     def _update_streaming_text(self, content: str):
         """ストリーミングテキストを更新"""
         self.streaming_text.config(state=tk.NORMAL)
         self.streaming_text.insert(tk.END, content)
+        
+        # 長い応答で再描画が重くならないよう、表示する文字数に上限を設ける
+        self._streaming_chars += len(content)
+        if self._streaming_chars > STREAMING_MAX_CHARS:
+            self.streaming_text.delete("1.0", f"1.0 + {STREAMING_TRIM_CHARS} chars")
+            self._streaming_chars -= STREAMING_TRIM_CHARS
+        
+        # 短い行が大量に続く場合に備えて行数にも上限を設ける（改行数はPython側で数える）
+        self._streaming_lines += content.count("\n")
+        if self._streaming_lines > STREAMING_MAX_LINES:
+            last_line = int(self.streaming_text.index("end-1c").split(".")[0])
+            self.streaming_text.delete("1.0", f"{last_line - STREAMING_KEEP_LINES}.0")
+            remaining = self.streaming_text.get("1.0", "end-1c")
+            self._streaming_lines = remaining.count("\n")
+            self._streaming_chars = len(remaining)
+        
         self.streaming_text.see(tk.END)
         self.streaming_text.config(state=tk.DISABLED)
     
@@ -983,34 +1272,32 @@ Full file content:
         self._stop_generating_animation()
         
         # 現在のメッセージがある場合、HTMLビューに転送
-        with self._message_lock:
-            current_msg = self._current_message
+        current_msg = "".join(self._current_message_parts)
         
         if current_msg:
             self._finalize_assistant_message(current_msg)
+            if self._pending_cache_key and not self._stop_generation:
+                self._store_cached_response(self._pending_cache_key, current_msg)
         elif self._stop_generation:
             # メッセージがない場合でも停止メッセージを追加
-            self._add_message("system", tr("[Generation stopped by user]"))
+            self._add_message("system", self._tr_stopped)
         
         self._reset_generation_state()
     
     def _finalize_assistant_message(self, message: str):
         """アシスタントメッセージを完了"""
         # アシスタントメッセージを追加
-        self.messages.append(("assistant", message))
-        
-        # HTMLビューに完全なメッセージを表示
-        self._update_html(full_reload=True)
+        self._record_message("assistant", message)
+        self._schedule_save()
         
-        # HTMLの更新完了後に最下部にスクロール
-        self.after(200, self._scroll_to_bottom)
+        # HTMLビューには新しいメッセージのみを追加（全体の再読み込みはしない）
+        self._append_message_js("assistant", message)
         
-        with self._message_lock:
-            self._current_message = ""
+        self._current_message_parts = []
         
         # 停止された場合のみ停止メッセージを追加
         if self._stop_generation:
-            self._add_message("system", tr("[Generation stopped by user]"))
+            self._add_message("system", self._tr_stopped)
     
     def _handle_edit_completion(self, full_response: str):
         """Edit mode完了時の処理"""
@@ -1077,21 +1364,16 @@ Full file content:
         """生成状態をリセット"""
         self._processing = False
         self._stop_generation = False
-        self.send_button.config(text=tr("Send"), state=tk.NORMAL)
+        self._pending_cache_key = None
+        self.send_button.config(text=self._tr_send, state=tk.NORMAL)
         
         # グローバルの生成状態を解除
-        from .. import set_llm_busy
         set_llm_busy(False)
     
-    def _delayed_update(self):
-        """遅延更新を実行（ストリーミング中は使用しない）"""
-        # 新しいアプローチでは使用しない
-        pass
-    
     def explain_code(self, code: str):
         """コードを説明（外部から呼ばれる）"""
-        # 既に生成中の場合は何もしない（ハンドラー側でチェック済み）
-        if self._processing:
+        # 既に生成中の場合や履歴の復元前は何もしない（ハンドラー側でチェック済み）
+        if self._processing or not self._history_loaded:
             return
         
         # 言語を検出
@@ -1100,10 +1382,35 @@ Full file content:
         # 説明用のプロンプトを生成
         message = self._build_code_explanation_prompt(code, lang)
         
+        # 同じ説明を既に生成済みならLLMを呼ばずに表示
+        key = self._explanation_cache_key(message)
+        if key is not None:
+            cached = self._response_cache.get(key)
+            if cached is not None:
+                self._response_cache.move_to_end(key)
+                self._add_messages([("user", message), ("assistant", cached)])
+                return
+        
         # プロンプトを入力して送信
         self.input_text.delete("1.0", tk.END)
         self.input_text.insert("1.0", message)
         self._send_message()
+        self._pending_cache_key = key if self._processing else None
+    
+    def _explanation_cache_key(self, message: str) -> Optional[bytes]:
+        """コード説明の応答キャッシュのキーを計算（キャッシュできない場合はNone）"""
+        # Edit modeやコンテキスト付きの場合は応答がエディタの内容に依存するためキャッシュしない
+        if self.mode_var.get() == "edit" or (self.context_var.get() and self.context_manager):
+            return None
+        data = f"{self._get_system_prompt()}|{message}".encode("utf-8")
+        return hashlib.blake2b(data, digest_size=16).digest()
+    
+    def _store_cached_response(self, key: bytes, response: str):
+        """コード説明の応答をキャッシュに保存"""
+        self._response_cache[key] = response
+        self._response_cache.move_to_end(key)
+        if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
     
     def _detect_current_file_language(self) -> str:
         """現在のファイルから言語を検出"""
@@ -1119,13 +1426,8 @@ Full file content:
     
     def _build_code_explanation_prompt(self, code: str, lang: str) -> str:
         """コード説明用のプロンプトを構築"""
-        workbench = get_workbench()
-        
-        # 言語設定を取得
-        language_setting = self._get_language_setting(workbench)
-        
-        # スキルレベルの指示を取得
-        skill_instruction = self._get_code_explanation_instruction(workbench)
+        # 言語設定とスキルレベルの指示を取得
+        language_setting, skill_instruction, _ = self._resolve_prompt_prefs()
         
         # 言語別のプロンプトを構築
         if language_setting == "Japanese":
@@ -1133,18 +1435,6 @@ Full file content:
         else:  # English
             return f"{skill_instruction}\n\nPlease explain this code:\n```{lang}\n{code}\n```"
     
-    def _get_code_explanation_instruction(self, workbench_settings) -> str:
-        """コード説明用のスキルレベル指示を取得"""
-        skill_level = workbench_settings.get_option("llm.skill_level", "beginner")
-        
-        skill_instructions = {
-            "beginner": "Explain in simple terms for a beginner. Avoid technical jargon and use plain language.",
-            "intermediate": "Explain assuming basic programming knowledge.",
-            "advanced": "Provide a detailed explanation including algorithmic efficiency and design considerations."
-        }
-        
-        return skill_instructions.get(skill_level, skill_instructions["beginner"])
-    
     def _explain_last_error(self):
         """最後のエラーを説明"""
         try:
@@ -1170,72 +1460,73 @@ Full file content:
             return None
         
         shell_text = shell_view.text
-        shell_content = shell_text.get("1.0", tk.END)
-        lines = shell_content.strip().split('\n')
+        content = shell_text.get("1.0", tk.END).strip()
         
-        error_lines = []
-        error_found = False
+        # 最後にエラーが出た位置を末尾からの検索で探す（全行を分割・走査しない）
+        pos = max(content.rfind(token) for token in ERROR_TOKENS)
+        if pos < 0:
+            return None
         
-        for i in range(len(lines) - 1, -1, -1):
-            line = lines[i]
-            
-            if error_found and (line.startswith(">>>") or line.startswith("===") or not line.strip()):
+        end = content.find('\n', pos)
+        if end < 0:
+            end = len(content)
+        start = content.rfind('\n', 0, pos) + 1
+        
+        # プロンプト行・区切り行・空行の直後までエラー出力を遡る
+        while start > 0:
+            prev_start = content.rfind('\n', 0, start - 1) + 1
+            line = content[prev_start:start - 1]
+            if line.startswith(">>>") or line.startswith("===") or not line.strip():
                 break
-            
-            if any(error_type in line for error_type in ["Error", "Exception", "Traceback"]):
-                error_found = True
-            
-            if error_found:
-                error_lines.insert(0, line)
+            start = prev_start
         
-        return '\n'.join(error_lines) if error_lines else None
+        return content[start:end]
     
     def _get_current_editor_code(self) -> str:
         """現在のエディタのコードを取得"""
         editor = get_workbench().get_editor_notebook().get_current_editor()
         if editor:
             try:
-                return editor.get_text_widget().get("1.0", tk.END).strip()
+                # 大きなファイル全体をコピーしないよう、必要な長さだけを読み込む
+                code = editor.get_text_widget().get("1.0", f"1.0 + {MAX_EDITOR_CHARS + 1} chars")
+                if len(code) > MAX_EDITOR_CHARS:
+                    return code[:MAX_EDITOR_CHARS].strip() + "\n# ... (truncated)"
+                return code.strip()
             except:
                 pass
         return ""
     
     def _build_error_explanation_prompt(self, error_message: str, code: str) -> str:
         """エラー説明用のプロンプトを構築"""
-        workbench_settings = get_workbench()
-        
-        # 言語設定を取得
-        language_setting = self._get_language_setting(workbench_settings)
-        
-        # スキルレベルの指示を取得
-        skill_instruction = self._get_skill_instruction(workbench_settings)
+        # 言語設定とスキルレベルの指示を取得
+        language_setting, _, skill_instruction = self._resolve_prompt_prefs()
         
         # 言語別のプロンプトを構築
         return self._format_error_prompt(language_setting, skill_instruction, error_message, code)
     
-    def _get_language_setting(self, workbench_settings) -> str:
-        """言語設定を取得"""
-        language_setting = workbench_settings.get_option("llm.output_language", "auto")
-        if language_setting == "auto":
-            thonny_lang = workbench_settings.get_option("general.language", "en")
-            return "Japanese" if thonny_lang.startswith("ja") else "English"
-        elif language_setting == "ja":
-            return "Japanese"
-        elif language_setting == "en":
-            return "English"
-        return "English"
-    
-    def _get_skill_instruction(self, workbench_settings) -> str:
-        """スキルレベルに応じた指示を取得"""
-        skill_level = workbench_settings.get_option("llm.skill_level", "beginner")
-        
-        skill_instructions = {
-            "beginner": "Explain the error in simple terms for a beginner and provide clear solutions.",
-            "intermediate": "Explain the error and solutions assuming basic programming knowledge.",
-            "advanced": "Provide a technical explanation of the error and efficient solutions."
-        }
+    def _resolve_prompt_prefs(self) -> tuple:
+        """(言語設定, コード説明用の指示, エラー説明用の指示) を取得（設定が変わるまでキャッシュ）"""
+        options = self._options
+        output_language = options["output_language"]
+        thonny_lang = options["thonny_language"]
+        skill_level = options["skill_level"]
+        
+        key = (output_language, thonny_lang, skill_level)
+        cached_key, cached_prefs = self._prompt_prefs_cache
+        if cached_key == key:
+            return cached_prefs
+        
+        if output_language == "auto":
+            language_setting = "Japanese" if thonny_lang.startswith("ja") else "English"
+        elif output_language == "ja":
+            language_setting = "Japanese"
+        else:
+            language_setting = "English"
         
-        return skill_instructions.get(skill_level, skill_instructions["beginner"])
+        instructions = SKILL_INSTRUCTIONS.get(skill_level, SKILL_INSTRUCTIONS["beginner"])
+        prefs = (language_setting, instructions["explain"], instructions["error"])
+        self._prompt_prefs_cache = (key, prefs)
+        return prefs
     
     def _format_error_prompt(self, language: str, skill_instruction: str, error_message: str, code: str) -> str:
         """エラープロンプトをフォーマット"""
@@ -1250,11 +1541,18 @@ Full file content:
             else:
                 return f"{skill_instruction}\n\nI encountered this error:\n```\n{error_message}\n```"
     
+    def _log_error_async(self, message: str, error: Exception):
+        """スタックトレース付きのエラーログをI/Oワーカーで出力（UIスレッドで整形しない）"""
+        exc_info = (type(error), error, error.__traceback__)
+        try:
+            self._io_executor.submit(logger.error, message, exc_info=exc_info)
+        except RuntimeError:
+            # ワーカー終了後はその場で出力
+            logger.error(message, exc_info=exc_info)
+    
     def _handle_explain_error_failure(self, error: Exception):
         """エラー説明の失敗を処理"""
-        import traceback
-        error_details = traceback.format_exc()
-        logger.error(f"Error in _explain_last_error: {error}\n{error_details}")
+        self._log_error_async(f"Error in _explain_last_error: {error}", error)
         messagebox.showerror(
             tr("Error"), 
             f"{tr('Failed to get error information')}: {str(error)}"
@@ -1268,16 +1566,22 @@ Full file content:
         self.wait_window(dialog)
         
         if hasattr(dialog, 'settings_changed') and dialog.settings_changed:
+            self._refresh_options()
+            self._system_prompt_cache = (None, None)
+            self._prompt_prefs_cache = (None, None)
+            self._refresh_translations()
             self._init_llm()
     
     def _clear_chat(self):
         """チャットをクリア"""
         self.messages.clear()
-        with self._message_lock:
-            self._current_message = ""
-        self._update_html(full_reload=True)  # クリア時は全体再読み込み
-        # 履歴もクリア
-        self._save_chat_history()
+        self._persistable_messages.clear()
+        self._unsaved_count = 0
+        self._rewrite_history = True
+        self._current_message_parts = []
+        self._clear_messages_js()
+        # 履歴もクリア（直後の追加とまとめて保存）
+        self._schedule_save()
     
     def _handle_edit_mode(self, user_prompt: str):
         """Edit modeでのメッセージ処理"""
@@ -1339,20 +1643,18 @@ Full file content:
                 for token in llm_client.generate_stream(prompt):
                     if self._stop_generation:
                         # 中止された場合もedit_completeを送信（部分的な応答で処理）
-                        self.message_queue.put(("edit_complete", full_response))
+                        self._post(("edit_complete", full_response))
                         return
                     full_response += token
-                    self.message_queue.put(("token", token))
+                    self._post(("token", token))
                 
                 # コードブロックを抽出
-                self.message_queue.put(("edit_complete", full_response))
+                self._post(("edit_complete", full_response))
                 
             except Exception as e:
-                self.message_queue.put(("error", str(e)))
+                self._post(("error", str(e)))
         
-        import threading
-        thread = threading.Thread(target=generate, daemon=True)
-        thread.start()
+        self._gen_requests.put((generate, ()))
     
     def _on_mode_change(self):
         """モード変更時の処理"""
@@ -1379,52 +1681,149 @@ Full file content:
                 self.context_manager = ContextManager()
     
     def _get_chat_history_path(self) -> Path:
-        """チャット履歴ファイルのパスを取得"""
-        workbench = get_workbench()
-        data_dir = Path(workbench.get_configuration_directory())
-        llm_dir = data_dir / "llm_assistant"
-        llm_dir.mkdir(exist_ok=True)
-        return llm_dir / "chat_history.json"
+        """チャット履歴ファイルのパスを取得（初回のみディレクトリを作成）"""
+        if self._history_path is None:
+            workbench = get_workbench()
+            data_dir = Path(workbench.get_configuration_directory())
+            llm_dir = data_dir / "llm_assistant"
+            llm_dir.mkdir(exist_ok=True)
+            self._history_path = llm_dir / "chat_history.jsonl"
+        return self._history_path
+    
+    def _collect_history_to_save(self) -> tuple:
+        """保存するメッセージと書き込み方法を決める（UIスレッドで呼ぶ）
+        
+        Returns:
+            (メッセージのリスト, ファイルを書き直すか)
+        """
+        # 追加時に絞り込み済みで、最新のHISTORY_SAVE_LIMIT件だけが残っている
+        messages = self._persistable_messages
+        new_count = min(self._unsaved_count, len(messages))
+        
+        # クリアされた場合、または行数が閾値に達した場合は最新分だけで書き直す
+        rewrite = (self._rewrite_history
+                   or self._saved_line_count + new_count >= HISTORY_REWRITE_THRESHOLD)
+        if rewrite:
+            messages_to_save = list(messages)
+            self._saved_line_count = 0
+        else:
+            messages_to_save = list(islice(messages, len(messages) - new_count, None))
+        
+        self._saved_line_count += len(messages_to_save)
+        self._unsaved_count = 0
+        self._rewrite_history = False
+        return messages_to_save, rewrite
+    
+    def _write_chat_history(self, history_path: Path, messages_to_save: list, rewrite: bool):
+        """チャット履歴をJSONLで書き込む（通常は追記、書き直しは一時ファイル経由で置き換える）"""
+        try:
+            lines = "".join(json.dumps(msg, ensure_ascii=False) + "\n" for msg in messages_to_save)
+            if rewrite:
+                tmp_path = history_path.with_suffix(".jsonl.tmp")
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(lines)
+                os.replace(tmp_path, history_path)
+            else:
+                with open(history_path, 'a', encoding='utf-8') as f:
+                    f.write(lines)
+        except Exception as e:
+            logger.error(f"Failed to save chat history: {e}")
+    
+    def _schedule_save(self):
+        """チャット履歴の保存を予約（連続した変更は最後の変更後の1回の保存にまとめる）"""
+        if self._save_after_id:
+            self.after_cancel(self._save_after_id)
+        self._save_after_id = self.after(SAVE_DEBOUNCE_MS, self._flush_save)
+    
+    def _flush_save(self):
+        """予約された保存を実行"""
+        self._save_after_id = None
+        self._save_chat_history()
     
     def _save_chat_history(self):
-        """チャット履歴を保存"""
+        """チャット履歴を保存（内容はUIスレッドで取得し、書き込みはI/Oワーカーで行う）"""
+        if self._save_after_id:
+            self.after_cancel(self._save_after_id)
+            self._save_after_id = None
         try:
-            # システムメッセージを除外して保存
-            messages_to_save = [
-                {"sender": sender, "text": text}
-                for sender, text in self.messages
-                if sender != "system" or not text.startswith("[")  # システムの状態メッセージを除外
-            ]
-            
-            # 最新の100メッセージのみ保存（メモリ節約）
-            messages_to_save = messages_to_save[-100:]
-            
+            if not (self._unsaved_count or self._rewrite_history):
+                return
             history_path = self._get_chat_history_path()
-            with open(history_path, 'w', encoding='utf-8') as f:
-                json.dump(messages_to_save, f, ensure_ascii=False, indent=2)
-                
+            messages_to_save, rewrite = self._collect_history_to_save()
+            self._io_executor.submit(self._write_chat_history, history_path, messages_to_save, rewrite)
         except Exception as e:
             logger.error(f"Failed to save chat history: {e}")
     
     def _load_chat_history(self):
-        """チャット履歴を読み込む"""
+        """チャット履歴をI/Oワーカーで読み込み、UIスレッドで反映する"""
         try:
             history_path = self._get_chat_history_path()
+        except Exception as e:
+            logger.error(f"Failed to load chat history: {e}")
+            self._history_loaded = True
+            self._update_send_button()
+            return
+        future = self._io_executor.submit(self._read_chat_history, history_path)
+        # ワーカースレッドからTkは呼ばず、結果はメッセージキュー経由でUIスレッドに渡す
+        future.add_done_callback(lambda f: self._post(("history", f.result())))
+    
+    def _read_chat_history(self, history_path: Path) -> tuple:
+        """チャット履歴ファイルを読み込む（I/Oワーカーで実行）
+        
+        Returns:
+            (最新HISTORY_SAVE_LIMIT件のメッセージ, ファイルの行数, 旧形式から読み込んだか)
+        """
+        try:
             if history_path.exists():
+                # 1行ずつ読み込む（壊れた行は読み飛ばす）
+                saved_messages = deque(maxlen=HISTORY_SAVE_LIMIT)
+                line_count = 0
                 with open(history_path, 'r', encoding='utf-8') as f:
-                    saved_messages = json.load(f)
-                
-                # 保存されたメッセージを復元
-                for msg in saved_messages:
-                    self.messages.append((msg["sender"], msg["text"]))
-                
-                if self.messages:
-                    # 履歴がある場合は、HTMLの準備後にシステムメッセージを追加
-                    self._update_html(full_reload=True)  # 履歴読み込み時は全体更新が必要
-                    self.after(300, lambda: self._add_message("system", tr("Previous conversation restored")))
-                    
+                    for line in f:
+                        line_count += 1
+                        try:
+                            saved_messages.append(json.loads(line))
+                        except ValueError:
+                            continue
+                return list(saved_messages), line_count, False
+            
+            # 旧形式（JSON配列）の履歴があれば読み込み、次回保存時に新形式で書き出す
+            legacy_path = history_path.with_suffix(".json")
+            if legacy_path.exists():
+                with open(legacy_path, 'r', encoding='utf-8') as f:
+                    return json.load(f)[-HISTORY_SAVE_LIMIT:], 0, True
         except Exception as e:
             logger.error(f"Failed to load chat history: {e}")
+        return [], 0, False
+    
+    def _apply_loaded_history(self, loaded: tuple):
+        """読み込んだチャット履歴を復元"""
+        saved_messages, line_count, legacy = loaded
+        try:
+            history = [(msg["sender"], msg["text"]) for msg in saved_messages]
+            # 読み込み前に記録されたメッセージ（接続メッセージなど）は未保存のまま
+            recorded = list(self._persistable_messages)
+            unsaved_count = self._unsaved_count
+            self._add_messages(history, save=False)
+            # 読み込んだ行はファイルに書き込み済みなので、未保存分が末尾に残るよう先頭に並べる
+            saved_rows = [
+                {"sender": sender, "text": text}
+                for sender, text in history if self._is_persistable(sender, text)
+            ]
+            self._persistable_messages = deque(saved_rows + recorded, maxlen=HISTORY_SAVE_LIMIT)
+            self._unsaved_count = unsaved_count
+            # 読み込み前に保存済みの行はファイルの読み込み後に追記されている
+            self._saved_line_count += line_count
+            self._rewrite_history = self._rewrite_history or legacy
+            
+            if history:
+                self._add_message("system", tr("Previous conversation restored"))
+                    
+        except Exception as e:
+            logger.error(f"Failed to restore chat history: {e}")
+        finally:
+            self._history_loaded = True
+            self._update_send_button()
     
     def _start_generating_animation(self):
         """生成中のアニメーションを開始（ストリーミングエリアを表示）"""
@@ -1437,6 +1836,9 @@ Full file content:
             # ストリーミングフレームを表示（HTMLビューと入力エリアの間に配置）
             self.streaming_frame.grid(row=2, column=0, sticky="ew", padx=3, pady=2)
             # ストリーミングテキストをクリアして準備
+            self._pending_tokens.clear()
+            self._streaming_chars = 0
+            self._streaming_lines = 0
             self.streaming_text.config(state=tk.NORMAL)
             self.streaming_text.delete("1.0", tk.END)
             self.streaming_text.config(state=tk.DISABLED)
@@ -1461,11 +1863,19 @@ Full file content:
     def _on_destroy(self, event):
         """ウィンドウが破棄される時のクリーンアップ"""
         # チャット履歴を保存
+        # 完了は待たない（ワーカーがTkに通知しようとしてUIスレッドと待ち合うのを防ぐ）
+        # 受け付け済みの書き込みは終了時にワーカースレッドの合流を待つ際に完了する
         self._save_chat_history()
+        self._io_executor.shutdown(wait=False)
         
         if hasattr(self, '_queue_check_id'):
             self.after_cancel(self._queue_check_id)
         
+        if self._html_ready_timeout_id:
+            self.after_cancel(self._html_ready_timeout_id)
+        
+        self._render_pool.shutdown(wait=False)
+        self._gen_requests.put(None)
         self._stop_generation = True
         
         if self.llm_client:
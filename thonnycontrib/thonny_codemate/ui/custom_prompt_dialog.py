@@ -6,7 +6,42 @@ from tkinter import ttk, scrolledtext
 from typing import Optional
 
 from thonny import get_workbench
-from ..i18n import tr
+from ..i18n import tr, get_current_language
+from ..prompts import (
+    DEFAULT_SYSTEM_PROMPT_TEMPLATE,
+    EDUCATIONAL_PRESET_TEMPLATE,
+    PROFESSIONAL_PRESET_TEMPLATE,
+    MINIMAL_PRESET_TEMPLATE,
+)
+
+# プリセットボタン（ラベル, テンプレート）の表示順
+_PRESETS = (
+    ("Default", DEFAULT_SYSTEM_PROMPT_TEMPLATE),
+    ("Educational", EDUCATIONAL_PRESET_TEMPLATE),
+    ("Professional", PROFESSIONAL_PRESET_TEMPLATE),
+    ("Minimal", MINIMAL_PRESET_TEMPLATE),
+)
+
+# ヒント欄に表示する文字列（変数の説明, ヒント...）
+_HINT_KEYS = (
+    "Variables: {skill_level} = 'beginner/intermediate/advanced (with detailed description)', {language} = 'ja/en/zh-CN/zh-TW/auto'",
+    "• Use {skill_level} to reference the user's skill level",
+    "• Use {language} to reference the output language",
+    "• Be specific about the coding style and explanation depth",
+    "• Include examples of how you want the AI to respond",
+)
+
+# 翻訳済みのヒント（言語コード, 文字列のタプル）
+_hints_cache = (None, ())
+
+
+def _translated_hints() -> tuple:
+    """ヒント欄の翻訳済み文字列を取得（言語が変わらない限り再翻訳しない）"""
+    global _hints_cache
+    lang = get_current_language()
+    if _hints_cache[0] != lang:
+        _hints_cache = (lang, tuple(tr(key) for key in _HINT_KEYS))
+    return _hints_cache[1]
 
 
 class CustomPromptDialog(tk.Toplevel):
@@ -55,17 +90,12 @@ class CustomPromptDialog(tk.Toplevel):
         hint_frame = ttk.LabelFrame(main_frame, text=tr("Tips"), padding="5")
         hint_frame.pack(fill="x", pady=(0, 10))
         
-        hints = [
-            tr("• Use {skill_level} to reference the user's skill level"),
-            tr("• Use {language} to reference the output language"),
-            tr("• Be specific about the coding style and explanation depth"),
-            tr("• Include examples of how you want the AI to respond")
-        ]
+        var_text, *hints = _translated_hints()
         
         # 変数の説明を追加
         var_explanation = ttk.Label(
             hint_frame,
-            text=tr("Variables: {skill_level} = 'beginner/intermediate/advanced (with detailed description)', {language} = 'ja/en/zh-CN/zh-TW/auto'"),
+            text=var_text,
             foreground="blue",
             wraplength=530
         )
@@ -92,33 +122,13 @@ class CustomPromptDialog(tk.Toplevel):
         
         ttk.Label(preset_frame, text=tr("Presets:")).pack(side="left", padx=(0, 10))
         
-        ttk.Button(
-            preset_frame,
-            text=tr("Default"),
-            command=self._insert_default_preset,
-            width=15
-        ).pack(side="left", padx=2)
-        
-        ttk.Button(
-            preset_frame,
-            text=tr("Educational"),
-            command=self._insert_educational_preset,
-            width=15
-        ).pack(side="left", padx=2)
-        
-        ttk.Button(
-            preset_frame,
-            text=tr("Professional"),
-            command=self._insert_professional_preset,
-            width=15
-        ).pack(side="left", padx=2)
-        
-        ttk.Button(
-            preset_frame,
-            text=tr("Minimal"),
-            command=self._insert_minimal_preset,
-            width=15
-        ).pack(side="left", padx=2)
+        for label, template in _PRESETS:
+            ttk.Button(
+                preset_frame,
+                text=tr(label),
+                command=lambda t=template: self._insert_preset(t),
+                width=15
+            ).pack(side="left", padx=2)
         
         # ボタンフレーム
         button_frame = ttk.Frame(main_frame)
@@ -137,37 +147,10 @@ class CustomPromptDialog(tk.Toplevel):
             style="Accent.TButton"
         ).pack(side="right")
     
-    def _insert_default_template(self):
-        """デフォルトのテンプレートを挿入"""
-        from ..prompts import DEFAULT_SYSTEM_PROMPT_TEMPLATE
-        
-        self.text_editor.delete("1.0", tk.END)
-        self.text_editor.insert("1.0", DEFAULT_SYSTEM_PROMPT_TEMPLATE)
-    
-    def _insert_educational_preset(self):
-        """教育向けプリセットを挿入"""
-        from ..prompts import EDUCATIONAL_PRESET_TEMPLATE
-        
+    def _insert_preset(self, template: str):
+        """プリセットのテンプレートでエディタの内容を置き換える"""
         self.text_editor.delete("1.0", tk.END)
-        self.text_editor.insert("1.0", EDUCATIONAL_PRESET_TEMPLATE)
-    
-    def _insert_professional_preset(self):
-        """プロフェッショナル向けプリセットを挿入"""
-        from ..prompts import PROFESSIONAL_PRESET_TEMPLATE
-        
-        self.text_editor.delete("1.0", tk.END)
-        self.text_editor.insert("1.0", PROFESSIONAL_PRESET_TEMPLATE)
-    
-    def _insert_minimal_preset(self):
-        """最小限のプリセットを挿入"""
-        from ..prompts import MINIMAL_PRESET_TEMPLATE
-        
-        self.text_editor.delete("1.0", tk.END)
-        self.text_editor.insert("1.0", MINIMAL_PRESET_TEMPLATE)
-    
-    def _insert_default_preset(self):
-        """デフォルトプリセットを挿入"""
-        self._insert_default_template()
+        self.text_editor.insert("1.0", template)
     
     def _save_and_close(self):
         """保存して閉じる"""
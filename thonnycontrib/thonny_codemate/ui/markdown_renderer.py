@@ -2,13 +2,55 @@
 Markdown renderer for chat messages
 Converts markdown to HTML and provides interactive features
 """
+import hashlib
 import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from html import escape as _html_escape
 from typing import Optional
 import markdown
 from pygments import highlight
 from pygments.lexers import get_lexer_by_name, PythonLexer
 from pygments.formatters import HtmlFormatter
 
+# レンダリング結果のキャッシュに保持するメッセージ数
+RENDER_CACHE_SIZE = 256
+
+# ハイライト結果のキャッシュに保持するコードブロック数
+HIGHLIGHT_CACHE_SIZE = 256
+
+# コードフェンス（```lang ... ```）。改行の有無に対応
+_CODE_FENCE_RE = re.compile(r'```(\w*)\n?(.*?)```', re.DOTALL)
+
+# Markdown変換後のコードブロック用プレースホルダー（<p>タグで囲まれている場合も考慮）
+_PLACEHOLDER_RE = re.compile(r'<p>CODEBLOCK(\d+)CODEBLOCK</p>|CODEBLOCK(\d+)CODEBLOCK')
+
+# HTML文書テンプレート内でメッセージを差し込む位置の目印
+_MESSAGES_SLOT = "<!--MESSAGES-->"
+
+# Pygmentsのフォーマッター（全インスタンスで共有）
+_FORMATTER = HtmlFormatter(style='friendly', nowrap=False)
+
+
+def _escape_html(text: str) -> str:
+    """HTMLエスケープ（&, <, > のみ。引用符はそのまま）"""
+    return _html_escape(text, quote=False)
+
+
+@lru_cache(maxsize=HIGHLIGHT_CACHE_SIZE)
+def _highlight(language: str, code: str) -> str:
+    """コードをシンタックスハイライトしたHTMLを返す（同じコードは再ハイライトしない）"""
+    try:
+        if language:
+            lexer = get_lexer_by_name(language, stripall=True)
+        else:
+            lexer = PythonLexer(stripall=True)
+        return highlight(code, lexer, _FORMATTER)
+    except Exception:
+        # フォールバック
+        return f'<pre><code>{_escape_html(code)}</code></pre>'
+
 
 class MarkdownRenderer:
     """Markdownテキストを対話機能付きのHTMLに変換"""
@@ -25,15 +67,21 @@ class MarkdownRenderer:
         )
         
         # Pygmentsのスタイルを設定
-        self.formatter = HtmlFormatter(style='friendly', nowrap=False)
+        self.formatter = _FORMATTER
         self.css_style = self.formatter.get_style_defs('.highlight')
         
-        # コードブロックのIDカウンター
-        self.code_block_id = 0
+        # メッセージ部分を除いたHTML文書の前後（get_full_htmlで毎回組み立てない）
+        self._html_prefix, self._html_suffix = self._build_page_template()
+        
+        # (sender, text) -> HTML のLRUキャッシュ
+        self._render_cache: "OrderedDict[tuple, str]" = OrderedDict()
+        
+        # Markdownインスタンスはスレッドセーフではないため、レンダリングを直列化
+        self._lock = threading.Lock()
     
     def render(self, text: str, sender: str = "assistant") -> str:
         """
-        MarkdownテキストをHTMLに変換
+        MarkdownテキストをHTMLに変換（同じメッセージはキャッシュから返す）
         
         Args:
             text: Markdownテキスト
@@ -42,10 +90,28 @@ class MarkdownRenderer:
         Returns:
             HTML文字列
         """
+        # システムメッセージはプレーンテキストなのでMarkdown変換もキャッシュも不要
+        if sender == "system":
+            content = self._escape_html(text).replace('\n', '<br />\n')
+            return self._wrap_message(f'<p>{content}</p>', sender)
+        
+        key = (sender, text)
+        with self._lock:
+            cached = self._render_cache.get(key)
+            if cached is not None:
+                self._render_cache.move_to_end(key)
+                return cached
+            
+            html = self._render_message(text, sender)
+            self._render_cache[key] = html
+            if len(self._render_cache) > RENDER_CACHE_SIZE:
+                self._render_cache.popitem(last=False)
+            return html
+    
+    def _render_message(self, text: str, sender: str) -> str:
+        """Markdownテキストを実際にHTMLへ変換"""
         # コードブロックを一時的に置換（後で処理）
         code_blocks = []
-        # より柔軟な正規表現パターン（改行の有無に対応）
-        code_pattern = re.compile(r'```(\w*)\n?(.*?)```', re.DOTALL)
         
         def replace_code_block(match):
             lang = match.group(1) or 'python'
@@ -56,22 +122,28 @@ class MarkdownRenderer:
             return f'\n\n{placeholder_id}\n\n'
         
         # コードブロックを一時的なプレースホルダーに置換
-        text_with_placeholders = code_pattern.sub(replace_code_block, text)
+        text_with_placeholders = _CODE_FENCE_RE.sub(replace_code_block, text)
         
         # Markdownを変換
         html_content = self.md.convert(text_with_placeholders)
         
-        # コードブロックを処理して戻す
-        for i, (lang, code) in enumerate(code_blocks):
-            code_html = self._render_code_block(lang, code)
-            placeholder = f'CODEBLOCK{i}CODEBLOCK'
-            # <p>タグで囲まれている場合も考慮
-            html_content = html_content.replace(f'<p>{placeholder}</p>', code_html)
-            html_content = html_content.replace(placeholder, code_html)
+        # コードブロックを処理して、プレースホルダーを1回の走査で戻す
+        if code_blocks:
+            rendered = [self._render_code_block(lang, code) for lang, code in code_blocks]
+            
+            def restore_code_block(match):
+                index = int(match.group(1) or match.group(2))
+                # 本文にたまたま同じ形の文字列がある場合はそのまま残す
+                return rendered[index] if index < len(rendered) else match.group(0)
+            
+            html_content = _PLACEHOLDER_RE.sub(restore_code_block, html_content)
         
-        # メッセージ全体をラップ
+        return self._wrap_message(html_content, sender)
+    
+    def _wrap_message(self, html_content: str, sender: str) -> str:
+        """メッセージ本文のHTMLをヘッダー付きの枠で囲む"""
         sender_class = f"message-{sender}"
-        full_html = f'''
+        return f'''
         <div class="message {sender_class}">
             <div class="message-header">{sender.title()}</div>
             <div class="message-content">
@@ -79,30 +151,18 @@ class MarkdownRenderer:
             </div>
         </div>
         '''
-        
-        return full_html
     
     def _render_code_block(self, language: str, code: str) -> str:
         """
         コードブロックをシンタックスハイライト付きでレンダリング
         Copy/Insertボタンも追加
         """
-        self.code_block_id += 1
-        block_id = f"code-block-{self.code_block_id}"
+        # 内容から決まるIDにして、同じ入力からは常に同じHTMLを生成する
+        digest = hashlib.blake2b(f"{language}\x00{code}".encode(), digest_size=6).hexdigest()
+        block_id = f"code-block-{digest}"
         
         # シンタックスハイライト
-        try:
-            if language:
-                lexer = get_lexer_by_name(language, stripall=True)
-            else:
-                lexer = PythonLexer(stripall=True)
-            highlighted_code = highlight(code, lexer, self.formatter)
-        except Exception:
-            # フォールバック
-            highlighted_code = f'<pre><code>{self._escape_html(code)}</code></pre>'
-        
-        # エスケープされたコードを保存（JavaScript用）
-        escaped_code = self._escape_js_string(code)
+        highlighted_code = _highlight(language, code)
         
         # HTMLを生成
         return f'''
@@ -129,18 +189,7 @@ class MarkdownRenderer:
     
     def _escape_html(self, text: str) -> str:
         """HTMLエスケープ"""
-        return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
-    
-    def _escape_js_string(self, text: str) -> str:
-        """JavaScript文字列用のエスケープ"""
-        # シングルクォート、ダブルクォート、改行、バックスラッシュをエスケープ
-        return (text
-            .replace('\\', '\\\\')
-            .replace("'", "\\'")
-            .replace('"', '\\"')
-            .replace('\n', '\\n')
-            .replace('\r', '\\r')
-            .replace('\t', '\\t'))
+        return _escape_html(text)
     
     def get_full_html(self, messages: list) -> str:
         """
@@ -152,17 +201,13 @@ class MarkdownRenderer:
         Returns:
             完全なHTML文書
         """
-        # コードブロックIDをリセット（完全再生成時）
-        self.code_block_id = 0
-        
-        # メッセージをレンダリング
-        messages_html = []
-        for sender, text in messages:
-            messages_html.append(self.render(text, sender))
-        
-        
-        # 完全なHTML文書を生成
-        return f'''
+        # メッセージをレンダリングし、生成済みの前後部分で挟む
+        messages_html = [self.render(text, sender) for sender, text in messages]
+        return self._html_prefix + ''.join(messages_html) + self._html_suffix
+    
+    def _build_page_template(self) -> tuple:
+        """HTML文書のメッセージ部分より前と後を生成（CSS/JSは固定なので一度だけ）"""
+        page = f'''
 <!DOCTYPE html>
 <html>
 <head>
@@ -467,18 +512,42 @@ class MarkdownRenderer:
 </head>
 <body>
     <div id="messages">
-        {''.join(messages_html)}
+        {_MESSAGES_SLOT}
     </div>
     <script>
-        // ページの準備完了を示すフラグ
-        window.pageReady = false;
+        // メッセージのHTMLを末尾に追加（Pythonから呼ばれる）
+        function appendMessages(html) {{
+            var messagesDiv = document.getElementById('messages');
+            if (!messagesDiv) {{
+                messagesDiv = document.createElement('div');
+                messagesDiv.id = 'messages';
+                document.body.appendChild(messagesDiv);
+            }}
+            if (messagesDiv.insertAdjacentHTML) {{
+                messagesDiv.insertAdjacentHTML('beforeend', html);
+            }} else {{
+                // insertAdjacentHTMLのないDOM（tkinterwebなど）向け
+                messagesDiv.innerHTML = messagesDiv.innerHTML + html;
+            }}
+            return true;
+        }}
         
-        // ページ読み込み時に最下部にスクロール
-        window.addEventListener('load', function() {{
-            window.scrollTo(0, document.body.scrollHeight);
-            window.pageReady = true;
-        }});
+        // ページの準備完了を示すフラグ
+        var pageReady = false;
+        
+        // DOM構築完了をPythonに一度だけ通知
+        // （本文の末尾で実行されるため要素は揃っている。windowやreadyStateには依存しない）
+        function notifyReady() {{
+            if (pageReady) return;
+            pageReady = true;
+            if (typeof pyHtmlReady !== 'undefined') {{
+                pyHtmlReady();
+            }}
+        }}
+        notifyReady();
     </script>
 </body>
 </html>
-        '''
\ No newline at end of file
+        '''
+        prefix, suffix = page.split(_MESSAGES_SLOT)
+        return prefix, suffix
@@ -3,7 +3,40 @@
 重複したエラーメッセージ処理ロジックを統一
 """
 from typing import Optional
-from ..tr import tr
+from ..i18n import tr
+
+
+# エラーメッセージのマッピング（キーワード, メッセージ）。先に一致したものが優先される
+_ERROR_MAPPINGS = (
+    # ネットワーク関連
+    ("connection", "Connection error. Please check your network and API settings."),
+    ("urlopen", "Cannot connect to server. Please check if the service is running."),
+    ("timeout", "Request timed out. The server may be busy or unreachable."),
+    ("refused", "Connection refused. Please check if the service is running."),
+    
+    # 認証関連
+    ("api key", "API key error. Please check your API key in settings."),
+    ("401", "Invalid API key. Please check your API key."),
+    ("403", "Access denied. Your API key may not have the required permissions."),
+    ("invalid_api_key", "Invalid API key. Please check your API key in settings."),
+    
+    # レート制限
+    ("rate limit", "Rate limit exceeded. Please try again later."),
+    ("429", "Too many requests. Please try again later."),
+    
+    # モデル関連
+    ("model", "Model error. The selected model may not be available."),
+    ("model not found", "Model not found. Please check the model name."),
+    ("not supported", "This model is not supported."),
+    
+    # ファイル関連
+    ("file not found", "File not found. Please check the file path."),
+    ("permission denied", "Permission denied. Cannot access the file."),
+    
+    # メモリ関連
+    ("out of memory", "Out of memory. Try using a smaller model or reducing context size."),
+    ("memory", "Memory error. Try reducing the context size."),
+)
 
 
 def get_user_friendly_error_message(error: Exception, context: str = "") -> str:
@@ -19,42 +52,10 @@ def get_user_friendly_error_message(error: Exception, context: str = "") -> str:
     """
     error_str = str(error).lower()
     
-    # エラーメッセージのマッピング
-    ERROR_MAPPINGS = {
-        # ネットワーク関連
-        "connection": tr("Connection error. Please check your network and API settings."),
-        "urlopen": tr("Cannot connect to server. Please check if the service is running."),
-        "timeout": tr("Request timed out. The server may be busy or unreachable."),
-        "refused": tr("Connection refused. Please check if the service is running."),
-        
-        # 認証関連
-        "api key": tr("API key error. Please check your API key in settings."),
-        "401": tr("Invalid API key. Please check your API key."),
-        "403": tr("Access denied. Your API key may not have the required permissions."),
-        "invalid_api_key": tr("Invalid API key. Please check your API key in settings."),
-        
-        # レート制限
-        "rate limit": tr("Rate limit exceeded. Please try again later."),
-        "429": tr("Too many requests. Please try again later."),
-        
-        # モデル関連
-        "model": tr("Model error. The selected model may not be available."),
-        "model not found": tr("Model not found. Please check the model name."),
-        "not supported": tr("This model is not supported."),
-        
-        # ファイル関連
-        "file not found": tr("File not found. Please check the file path."),
-        "permission denied": tr("Permission denied. Cannot access the file."),
-        
-        # メモリ関連
-        "out of memory": tr("Out of memory. Try using a smaller model or reducing context size."),
-        "memory": tr("Memory error. Try reducing the context size."),
-    }
-    
-    # エラーメッセージをチェック
-    for key, message in ERROR_MAPPINGS.items():
-        if key in error_str:
-            return message
+    # 最初に一致したキーワードのメッセージだけを翻訳する
+    message = next((msg for key, msg in _ERROR_MAPPINGS if key in error_str), None)
+    if message is not None:
+        return tr(message)
     
     # デフォルトメッセージ
     if context: